@@ -3,9 +3,15 @@ import uuid
 import subprocess
 import os
 import json
+import hashlib
+import socket
+import time
 import boto3
+from decimal import Decimal
 
-from botocore.exceptions import ClientError
+from botocore.exceptions import BotoCoreError, ClientError
+
+import shards
 
 
 import sys
@@ -15,34 +21,255 @@ from configparser import SafeConfigParser
 config = SafeConfigParser(os.environ)
 config.read('ann_config.ini')
 
+def download_and_hash(s3, bucket_name, key, local_file_path, chunk_size=1024 * 1024):
+    """Stream an S3 object to a local file, hashing it on the way
+
+    Returns the SHA-256 hex digest of the object, used by run.py to look
+    up results of an identical earlier input.
+    """
+    sha256 = hashlib.sha256()
+    response = s3.get_object(Bucket=bucket_name, Key=key)
+    with open(local_file_path, 'wb') as f:
+        for chunk in response['Body'].iter_chunks(chunk_size):
+            sha256.update(chunk)
+            f.write(chunk)
+    return sha256.hexdigest()
+
+def as_seconds(secs):
+    """DynamoDB-storable duration, rounded to milliseconds"""
+    return Decimal(str(round(secs, 3)))
+
+def claim_job(table, job_id, worker_id):
+    """Atomically take ownership of a job
+
+    A job can be claimed while PENDING, or while RUNNING if the lease of
+    the worker holding it has expired (that worker or its run.py died)
+    or it has no lease at all (it was started before leases existed).
+    Sharded parents are only taken over while none of their shards has
+    completed, so an interrupted dispatch_shards is simply run again.
+    Returns True if this worker now holds the job.
+    """
+    now = int(time.time())
+    try:
+        table.update_item(
+            Key={'job_id': job_id},
+            UpdateExpression='SET job_status = :running, worker_id = :worker, lease_expiry = :expiry',
+            ConditionExpression='job_status = :pending OR (job_status = :running AND (lease_expiry < :now OR attribute_not_exists(lease_expiry)) AND (attribute_not_exists(shards_total) OR shards_completed = :zero))',
+            ExpressionAttributeValues={
+                ':pending': 'PENDING',
+                ':running': 'RUNNING',
+                ':zero': 0,
+                ':worker': worker_id,
+                ':now': now,
+                ':expiry': now + config.getint('LEASE', 'LeaseSeconds')
+            })
+    except ClientError as e:
+        if e.response['Error']['Code'] == "ConditionalCheckFailedException":
+            return False
+        raise
+    return True
+
+def parent_completed(table, parent_job_id):
+    """Whether a sharded job's shards have been merged"""
+    parent = table.get_item(Key={'job_id': parent_job_id},
+        ConsistentRead=True).get('Item', {})
+    return parent.get('job_status') == 'COMPLETED'
+
+def launch_run(input_file_name, job_id, user_email, user_id, run_args,
+    worker_id, queue_url, receipt_handle, timings):
+    """Start run.py for a job in the background; returns its process"""
+    return subprocess.Popen(['python', 'run.py', 'download/'+input_file_name, job_id, user_email,user_id] + run_args,
+        env=dict(os.environ, JOB_WORKER_ID=worker_id,
+            JOB_QUEUE_URL=queue_url, JOB_RECEIPT_HANDLE=receipt_handle,
+            JOB_TIMINGS=json.dumps(
+            {phase: float(secs) for phase, secs in timings.items()})))
+
+def dispatch_shards(s3, table, job, size, timings, lane):
+    """Split a large input into shards and enqueue them as sub-jobs
+
+    Each sub-job annotates the VCF header plus one line-aligned byte range
+    of the original S3 object; the worker finishing the last shard merges
+    the results (see run.py). The parent job records how many shards must
+    complete before it is marked COMPLETED. Shards stay in the parent's
+    priority lane.
+    """
+    shard_size = config.getint('SHARDS', 'ShardSizeMB') * 1024 * 1024
+    header_end, ranges = shards.plan_shards(s3, job['s3_inputs_bucket'],
+        job['key'], size, shard_size)
+
+    # The parent is already claimed; once a shard completes, shards_total
+    # keeps it from being taken over (see claim_job). Until then a failed
+    # dispatch is redelivered and run again, so every step is repeatable
+    table.update_item(
+        Key={'job_id': job['job_id']},
+        UpdateExpression='SET shards_total = :total, shards_completed = :zero, job_timings = :timings',
+        ExpressionAttributeValues={
+            ':total': len(ranges),
+            ':zero': 0,
+            ':timings': timings
+        })
+
+    for shard_index in range(len(ranges)):
+        try:
+            # Never reset a shard an earlier dispatch already started
+            table.put_item(Item={
+                'job_id': shards.shard_job_id(job['job_id'], shard_index),
+                'parent_job_id': job['job_id'],
+                'shard_index': shard_index,
+                'submit_time': job['submit_time'],
+                'job_status': 'PENDING'
+            }, ConditionExpression='attribute_not_exists(job_id)')
+        except ClientError as e:
+            if e.response['Error']['Code'] != "ConditionalCheckFailedException":
+                raise
+
+    sns_client = boto3.client('sns', region_name='us-east-1')
+    for shard_index, byte_range in enumerate(ranges):
+        sub_job_id = shards.shard_job_id(job['job_id'], shard_index)
+        sub_job = dict(job,
+            job_id=sub_job_id,
+            parent_job_id=job['job_id'],
+            shard_index=shard_index,
+            shard_count=len(ranges),
+            header_end=header_end,
+            byte_range=list(byte_range))
+        sns_client.publish(
+            TopicArn=lane['topic'],
+            Message=json.dumps({"default": json.dumps(sub_job)}),
+            MessageStructure='json',
+            MessageGroupId=sub_job_id,
+            MessageDeduplicationId=sub_job_id)
+    print(f"Job {job['job_id']} split into {len(ranges)} shards.")
+
+class LaneScheduler(object):
+    """Weighted-fair choice between priority lanes
+
+    Uses smooth weighted round robin: whenever a lane delivers a job every
+    eligible lane that may have work earns its weight in credit and the
+    serving lane pays their total, so under load lanes are served in
+    proportion to their weights and no lane with a non-zero weight is
+    ever starved. Idle lanes bank nothing: a lane just polled empty earns
+    no credit and loses any it had, and credit is kept within plus or
+    minus the total weight, so a lane returning after a one-sided stretch
+    gets at most a brief catch-up rather than a long burst.
+    """
+    def __init__(self, lanes):
+        self.lanes = lanes
+        self.credit = {lane['name']: 0 for lane in lanes}
+
+    def order(self, eligible):
+        """Eligible lanes in the order they should be polled"""
+        return sorted(eligible, reverse=True,
+            key=lambda lane: self.credit[lane['name']] + lane['weight'])
+
+    def charge(self, eligible, served, empty=()):
+        """Account for a job taken from the served lane
+
+        empty lists the lanes polled without result before it.
+        """
+        empty_names = {lane['name'] for lane in empty}
+        active = [lane for lane in eligible if lane['name'] not in empty_names]
+        for lane in active:
+            self.credit[lane['name']] += lane['weight']
+        self.credit[served['name']] -= sum(lane['weight'] for lane in active)
+        for name in empty_names:
+            self.credit[name] = min(self.credit[name], 0)
+        bound = sum(lane['weight'] for lane in self.lanes)
+        for name in self.credit:
+            self.credit[name] = max(-bound, min(bound, self.credit[name]))
+
+def load_lanes():
+    """Priority lanes (queue, topic, weight) from ann_config.ini"""
+    lanes = []
+    for name in config['LANES']['Lanes'].split(','):
+        section = config['LANE_' + name.strip()]
+        lanes.append({
+            'name': name.strip(),
+            'url': section['QueueURL'],
+            'topic': section['TopicARN'],
+            'weight': int(section['Weight'])
+        })
+    return lanes
+
+def put_lane_metrics(cloudwatch, metrics):
+    """Publish (metric name, lane, value, unit) tuples to CloudWatch"""
+    try:
+        cloudwatch.put_metric_data(
+            Namespace=config['METRICS']['Namespace'],
+            MetricData=[{
+                'MetricName': name,
+                'Dimensions': [{'Name': 'Lane', 'Value': lane}],
+                'Value': value,
+                'Unit': unit} for name, lane, value, unit in metrics])
+    except ClientError as e:
+        print(e.response['Error']['Message'])
+
 def request_annotation():
 
     # Extract job parameters from the request body (NOT the URL query string!)
     # try:
 
-        sqs = boto3.resource('sqs', region_name='us-east-1')
         sqs_client = boto3.client('sqs',region_name='us-east-1')
+        cloudwatch = boto3.client('cloudwatch', region_name='us-east-1')
 
-        queue_name = config['ANN']['QueueName']
-        # Get the queue
-        queue = sqs.get_queue_by_name(QueueName=queue_name)
-        queue_url = config['ANN']['QueueURL']
+        lanes = load_lanes()
+        scheduler = LaneScheduler(lanes)
+        max_running = config.getint('LANES', 'MaxRunningJobs')
+        reserved = config.getint('LANES', 'ReservedPremiumJobs')
+        running = []
+        last_metrics = 0
+        worker_id = f"{socket.gethostname()}:{os.getpid()}"
         # Receive messages 
         while True:
-            response = sqs_client.receive_message(
-                QueueUrl=queue_url, 
-                AttributeNames=['All'], 
-                MaxNumberOfMessages=1, 
-                WaitTimeSeconds=20, VisibilityTimeout=30
-            )
-            try: 
-                message = response['Messages'][0]
-                message_body = message['Body']
-                receipt_handle = message['ReceiptHandle']
-            except KeyError: # No messages in queue
+            # Report per-lane queue depth periodically
+            if time.time() - last_metrics >= config.getint('LANES', 'MetricsIntervalSeconds'):
+                depths = []
+                for lane in lanes:
+                    attributes = sqs_client.get_queue_attributes(
+                        QueueUrl=lane['url'],
+                        AttributeNames=['ApproximateNumberOfMessages'])['Attributes']
+                    depths.append(('QueueDepth', lane['name'],
+                        int(attributes['ApproximateNumberOfMessages']), 'Count'))
+                put_lane_metrics(cloudwatch, depths)
+                last_metrics = time.time()
+
+            # Free jobs may not take the slots reserved for premium jobs
+            running = [p for p in running if p.poll() is None]
+            eligible = [lane for lane in lanes
+                if len(running) < max_running - (0 if lane['name'] == 'premium' else reserved)]
+            if not eligible:
+                time.sleep(1)
+                continue
+
+            message = None
+            empty = []
+            for lane in scheduler.order(eligible):
+                response = sqs_client.receive_message(
+                    QueueUrl=lane['url'], 
+                    AttributeNames=['All'], 
+                    MaxNumberOfMessages=1, 
+                    WaitTimeSeconds=config.getint('LANES', 'LaneWaitTimeSeconds'),
+                    VisibilityTimeout=30
+                )
+                if response.get('Messages'):
+                    message = response['Messages'][0]
+                    break
+                empty.append(lane)
+            if message is None: # No messages in any lane
                 print({'code': 400, 'status': 'error', 'message': 'Empty Queue'})
                 continue
+            scheduler.charge(eligible, lane, empty)
+            queue_url = lane['url']
+            message_body = message['Body']
+            receipt_handle = message['ReceiptHandle']
             message_dict = json.loads(json.loads(message_body)['Message'])
+            # Latency breakdown, recorded on the job item as job_timings
+            timings = {}
+            if message_dict.get('submit_time'):
+                timings['queue_wait'] = as_seconds(
+                    time.time() - float(message_dict['submit_time']))
+                put_lane_metrics(cloudwatch, [('QueueWait', lane['name'],
+                    float(timings['queue_wait']), 'Seconds')])
           
             bucket_name = message_dict.get('s3_inputs_bucket')
             job_id = message_dict.get('job_id')
@@ -51,6 +278,7 @@ def request_annotation():
             input_file_name = message_dict.get('input_file_name')
             s3_key_input_file = message_dict.get('s3_key_input_file')
             key = message_dict.get('key')
+            parent_job_id = message_dict.get('parent_job_id')
             if not bucket_name or not key:
                 print({'code': 400, 'status': 'error', 'message': 'Missing bucket name or key'})
             
@@ -58,42 +286,122 @@ def request_annotation():
             home_dir = os.path.expanduser('~/mpcs-cc/gas/ann/')
             data_dir = os.path.join(home_dir,'download')
             os.makedirs(data_dir, exist_ok=True)  # Ensure the directory exists
-            local_file_path = os.path.join(data_dir, input_file_name)
 
             s3 = boto3.client('s3')
-            s3.download_file(bucket_name, key, local_file_path)
-
             dynamodb = boto3.resource('dynamodb')
             dynamobName = config['AWS']['DynamodbName']
             table = dynamodb.Table(dynamobName)
 
+            # Claim the job before doing any work, so duplicate deliveries are free
+            reduce_only = False
+            if not claim_job(table, job_id, worker_id):
+                job = table.get_item(Key={'job_id': job_id},
+                    ConsistentRead=True).get('Item', {})
+                if job.get('job_status') == 'COMPLETED' and parent_job_id and \
+                    not parent_completed(table, parent_job_id):
+                    # Counted, but its parent was never merged (the reducer
+                    # died); run.py skips straight to the reduce
+                    reduce_only = True
+                elif job.get('job_status') == 'RUNNING' and \
+                    ('shards_total' not in job or job.get('shards_completed') == 0):
+                    # Held by another worker; look again once its lease runs out
+                    sqs_client.change_message_visibility(
+                        QueueUrl=queue_url,
+                        ReceiptHandle=receipt_handle,
+                        VisibilityTimeout=min(43200,
+                            max(0, int(job.get('lease_expiry', 0)) - int(time.time())) + 1))
+                    continue
+                else:
+                    print(f"Job {job_id} already claimed ({job.get('job_status')}); skipping.")
+                    sqs_client.delete_message(
+                        QueueUrl=queue_url,
+                        ReceiptHandle=receipt_handle)
+                    continue
+
+            # Keep the message hidden for the lease; run.py deletes it when done
+            sqs_client.change_message_visibility(
+                QueueUrl=queue_url,
+                ReceiptHandle=receipt_handle,
+                VisibilityTimeout=config.getint('LEASE', 'LeaseSeconds'))
+
+            if reduce_only:
+                running.append(launch_run(job_id + '~' + input_file_name, job_id,
+                    user_email, user_id, ['', parent_job_id,
+                        str(message_dict['shard_index']),
+                        str(message_dict['shard_count'])],
+                    worker_id, queue_url, receipt_handle, timings))
+                continue
+
+            # Scale very large inputs out across workers as shard sub-jobs
+            if not parent_job_id:
+                try:
+                    size = s3.head_object(Bucket=bucket_name, Key=key)['ContentLength']
+                except ClientError as e:
+                    if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                        # The upload never completed; nothing to annotate
+                        print(f"Input {key} of job {job_id} not found; dropping request.")
+                        sqs_client.delete_message(
+                            QueueUrl=queue_url,
+                            ReceiptHandle=receipt_handle)
+                    else:
+                        print(e.response['Error']['Message'])
+                    continue
+                if size > config.getint('SHARDS', 'ShardThresholdMB') * 1024 * 1024:
+                    try:
+                        dispatch_shards(s3, table, message_dict, size, timings, lane)
+                        sqs_client.delete_message(
+                            QueueUrl=queue_url,
+                            ReceiptHandle=receipt_handle)
+                    except (ClientError, BotoCoreError) as e:
+                        # Redelivered once the lease runs out and dispatched again
+                        print(e)
+                    continue
+
+            download_start = time.time()
+            # Local files are named by job ID, so jobs (and shards) with the
+            # same input file name never share stage files or checkpoints
+            input_file_name = job_id + '~' + input_file_name
+            local_file_path = os.path.join(data_dir, input_file_name)
+            if parent_job_id:
+                shards.download_shard(s3, bucket_name, key,
+                    message_dict['header_end'], message_dict['byte_range'],
+                    local_file_path)
+                run_args = ['', parent_job_id,
+                    str(message_dict['shard_index']),
+                    str(message_dict['shard_count'])]
+            else:
+                input_hash = download_and_hash(s3, bucket_name, key, local_file_path)
+                run_args = [input_hash]
+            timings['download'] = as_seconds(time.time() - download_start)
+
+            # Record timings and extend the lease; run.py renews it from here on
             try:
                 response = table.update_item(
                     Key={
                     'job_id': job_id,
                     },
-                    UpdateExpression='SET job_status = :status',
+                    UpdateExpression='SET job_timings = :timings, lease_expiry = :expiry',
                     ExpressionAttributeValues={
-                        ':status': 'RUNNING',
-                        ':pending': 'PENDING'
+                        ':timings': timings,
+                        ':worker': worker_id,
+                        ':expiry': int(time.time()) + config.getint('LEASE', 'LeaseSeconds')
                     },
-                    ConditionExpression='job_status = :pending',  # Ensure the current status is PENDING
+                    ConditionExpression='worker_id = :worker',  # Ensure we still hold the job
                     ReturnValues="UPDATED_NEW"
                         )
             except ClientError as e:
                 if e.response['Error']['Code'] == "ConditionalCheckFailedException":
-                    print("Job status update condition not met (not PENDING).")
-                    # Handle the condition not met case, e.g., log, raise an exception, etc.
+                    print(f"Lost claim on job {job_id} during download; skipping.")
                 else:
-                    # Handle other possible exceptions
                     print(e.response['Error']['Message'])
+                os.remove(local_file_path)
+                continue
             
              # Launch annotation job as a background process
             try:
-                ann_process = subprocess.Popen(['python', 'run.py', 'download/'+input_file_name, job_id, user_email,user_id])
-                response = sqs_client.delete_message(
-                    QueueUrl=queue_url, 
-                    ReceiptHandle=receipt_handle)
+                running.append(launch_run(input_file_name, job_id, user_email,
+                    user_id, run_args, worker_id, queue_url, receipt_handle,
+                    timings))
 
             except Exception as e:
                 print(e)
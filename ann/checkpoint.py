@@ -0,0 +1,120 @@
+# checkpoint.py
+#
+# Stage-level checkpoints for driver.run, so a job interrupted by a worker
+# crash or instance recycling resumes after its last completed stage
+#
+##
+
+import os
+import json
+from boto3.exceptions import S3UploadFailedError
+from botocore.exceptions import BotoCoreError, ClientError
+
+
+class Checkpoint(object):
+    """Records the last completed pipeline stage of one input file
+
+    Stage N's output (infile.N) is already kept on local disk until the
+    pipeline finishes, so a local checkpoint only needs the stage number
+    and the size of the .count.log at that point (stages append to the
+    log, and a stage interrupted after writing its log lines must not
+    leave them behind). If an S3 location is given, the stage output and
+    log are also copied there after every stage, so another worker can
+    pick the job up. The state records the job ID, and a checkpoint left
+    by any other job is ignored.
+    """
+    def __init__(self, infile, job_id, s3=None, bucket=None, prefix=None):
+        self.infile = infile
+        self.job_id = job_id
+        self.path = infile + '.checkpoint'
+        self.log_file = infile + '.count.log'
+        self.s3 = s3
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def s3_key(self, name):
+        return self.prefix + name
+
+    def load(self):
+        """Restore the latest checkpoint; returns the last completed stage"""
+        state = self.load_local()
+        if state is not None and state.get('job_id') != self.job_id:
+            state = None
+        if state is None and self.s3:
+            state = self.load_s3()
+        if state is None:
+            return 0
+        stage_output = f"{self.infile}.{state['stage']}"
+        if not os.path.isfile(stage_output) or not os.path.isfile(self.log_file):
+            return 0
+        with open(self.log_file, 'r+') as f:
+            f.truncate(state['log_size'])
+        print(f"Resuming {self.infile} after stage {state['stage']}.")
+        return state['stage']
+
+    def load_local(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def load_s3(self):
+        """Fetch checkpoint state, stage output and log from S3"""
+        try:
+            response = self.s3.get_object(Bucket=self.bucket,
+                Key=self.s3_key('checkpoint.json'))
+            state = json.loads(response['Body'].read())
+            if state.get('job_id') != self.job_id:
+                return None
+            self.s3.download_file(self.bucket,
+                self.s3_key(f"stage.{state['stage']}"),
+                f"{self.infile}.{state['stage']}")
+            self.s3.download_file(self.bucket,
+                self.s3_key(f"count.log.{state['stage']}"), self.log_file)
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                print(f"Unable to restore checkpoint from S3: {e}")
+            return None
+        return state
+
+    def save(self, stage):
+        """Record that stage has completed"""
+        state = {'job_id': self.job_id, 'stage': stage,
+            'log_size': os.path.getsize(self.log_file)}
+        if self.s3:
+            # Stage output first, so checkpoint.json never runs ahead of it;
+            # the previous stage's copies are only dropped afterwards
+            try:
+                self.s3.upload_file(f'{self.infile}.{stage}', self.bucket,
+                    self.s3_key(f'stage.{stage}'))
+                self.s3.upload_file(self.log_file, self.bucket,
+                    self.s3_key(f'count.log.{stage}'))
+                self.s3.put_object(Bucket=self.bucket,
+                    Key=self.s3_key('checkpoint.json'), Body=json.dumps(state))
+                if stage > 1:
+                    self.delete_s3([f'stage.{stage - 1}', f'count.log.{stage - 1}'])
+            except (ClientError, BotoCoreError, S3UploadFailedError) as e:
+                # S3 checkpoints are optional; the local one still applies
+                print(f"Unable to save checkpoint to S3: {e}")
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.replace(self.path + '.tmp', self.path)
+
+    def delete_s3(self, names):
+        self.s3.delete_objects(Bucket=self.bucket, Delete={
+            'Objects': [{'Key': self.s3_key(name)} for name in names]})
+
+    def clear(self, stage_count):
+        """Remove all checkpoint state once the job has completed"""
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+        if self.s3:
+            try:
+                self.delete_s3(['checkpoint.json'] +
+                    [f'stage.{stage}' for stage in range(1, stage_count + 1)] +
+                    [f'count.log.{stage}' for stage in range(1, stage_count + 1)])
+            except ClientError as e:
+                print(f"Unable to remove checkpoint from S3: {e}")
+
+### EOF
@@ -12,110 +12,83 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import sys
 import os
+import time
 import file_utils as fu
 import annotate as ann
 
-def run(infile, format):
+"""Pipeline stages in run order; stage N reads infile.<N-1> (the input
+itself for stage 1) and writes infile.<N>
+"""
+STAGES = ['dbSNP', 'bigRefGene', 'refGene', 'cytoBand', 'gadAll',
+    'gwasCatalog', 'targetScanS', 'hugo', 'dgv_Cnv',
+    'abParts_IG_T_CelReceptors', 'mcCarroll_Cnv', 'conrad_Cnv',
+    'genomicSuperDups', 'tfbsConsSites']
 
-    print("Running . . .")
-
-    ann.getSnpsFromDbSnp(vcf=infile, format='vcf', tmpextin='', 
-        tmpextout='.1')
-    print("dbSNP - done.")
-    tmpextin = 1
-    tmpextout = 2
-
-    ann.getBigRefGene(vcf=infile, format='vcf', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.getGenes(vcf=infile, format='vcf', table='refGene', 
-        promoter_offset=500, tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("BigRefGene - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCytoband(vcf=infile, format='vcf', table='cytoBand', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("Cytoband - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGadAll(vcf=infile, format='vcf', table='gadAll', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("gadAll - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
+"""Record how long a pipeline stage took
+"""
+def record_stage(timings, stage, start):
+    timings[f'stage_{stage:02d}_{STAGES[stage - 1]}'] = time.time() - start
 
-    ann.addOverlapWithGwasCatalog(vcf=infile, format='vcf', 
-        table='gwasCatalog', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("GwasCatalog - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
+def run(infile, format, timings=None, checkpoint=None):
 
-    ann.addOverlapWithMiRNA(vcf=infile, format='vcf', table='targetScanS', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("miRNA - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
+    # Per-stage wall-clock durations, keyed in pipeline order
+    timings = {} if timings is None else timings
 
-    ann.addOverlapWitHUGOGeneNomenclature(vcf=infile, format='vcf', 
-        table='hugo', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("HUGO Gene Nomenclature Committee - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
+    # Stages already completed by an earlier, interrupted run
+    completed = checkpoint.load() if checkpoint else 0
 
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', table='dgv_Cnv', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("dgv_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='abParts_IG_T_CelReceptors', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("abParts_IG_T_CelReceptors - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='mcCarroll_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("mcCarroll_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='conrad_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
-    print("conrad_Cnv - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
-
-    ann.addOverlapWithGenomicSuperDups(vcf=infile, format='vcf', 
-        table='genomicSuperDups', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
-    print("genomicSuperDups - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
+    print("Running . . .")
 
-    ann.addOverlapWithTfbsConsSites(vcf=infile, table='tfbsConsSites',
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
-    print("addOverlapWithTfbsConsSites - done.")
-    tmpextin = tmpextin + 1
-    tmpextout = tmpextout + 1
+    # (annotation function, extra arguments, completion message) in the
+    # order given by STAGES
+    stages = [
+        (ann.getSnpsFromDbSnp, {}, "dbSNP - done."),
+        (ann.getBigRefGene, {}, "BigRefGene - done."),
+        (ann.getGenes, {'table': 'refGene', 'promoter_offset': 500},
+            "BigRefGene - done."),
+        (ann.addOverlapWithCytoband, {'table': 'cytoBand'}, "Cytoband - done."),
+        (ann.addOverlapWithGadAll, {'table': 'gadAll'}, "gadAll - done."),
+        (ann.addOverlapWithGwasCatalog, {'table': 'gwasCatalog'},
+            "GwasCatalog - done."),
+        (ann.addOverlapWithMiRNA, {'table': 'targetScanS'}, "miRNA - done."),
+        (ann.addOverlapWitHUGOGeneNomenclature, {'table': 'hugo'},
+            "HUGO Gene Nomenclature Committee - done."),
+        (ann.addOverlapWithCnvDatabase, {'table': 'dgv_Cnv'}, "dgv_Cnv - done."),
+        (ann.addOverlapWithCnvDatabase, {'table': 'abParts_IG_T_CelReceptors'},
+            "abParts_IG_T_CelReceptors - done."),
+        (ann.addOverlapWithCnvDatabase, {'table': 'mcCarroll_Cnv'},
+            "mcCarroll_Cnv - done."),
+        (ann.addOverlapWithCnvDatabase, {'table': 'conrad_Cnv'},
+            "conrad_Cnv - done."),
+        (ann.addOverlapWithGenomicSuperDups, {'table': 'genomicSuperDups'},
+            "genomicSuperDups - done."),
+        (ann.addOverlapWithTfbsConsSites, {'table': 'tfbsConsSites'},
+            "addOverlapWithTfbsConsSites - done."),
+    ]
+
+    for stage, (annotate, kwargs, message) in enumerate(stages, 1):
+        if stage <= completed:
+            print(f"{STAGES[stage - 1]} - restored from checkpoint.")
+            record_stage(timings, stage, time.time())
+            continue
+        stage_start = time.time()
+        tmpextin = '.' + str(stage - 1) if stage > 1 else ''
+        annotate(vcf=infile, format='vcf', tmpextin=tmpextin,
+            tmpextout='.' + str(stage), **kwargs)
+        print(message)
+        record_stage(timings, stage, stage_start)
+        if checkpoint:
+            checkpoint.save(stage)
 
     ## Cleanup
-    for i in range(1, tmpextin):
+    for i in range(1, len(stages)):
         fu.delete(infile + '.' + str(i))
 
-    os.rename(infile + '.' + str(tmpextin), infile + '.annot')
+    os.rename(infile + '.' + str(len(stages)), infile + '.annot')
     finalout=(infile + '.annot').replace('.vcf.annot', '.annot.vcf')
     os.rename(infile + '.annot', finalout)
 
+    if checkpoint:
+        checkpoint.clear(len(stages))
+
 ### EOF
\ No newline at end of file
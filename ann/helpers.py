@@ -41,38 +41,81 @@ def send_email_ses(recipients=None,
   return response
 
 
+import time
+import threading
 import psycopg2
 import psycopg2.extras
+import psycopg2.pool
+
+"""Process-wide state for profile lookups: the accounts database secret,
+one connection pool per database, and a short-TTL profile cache
+"""
+_profile_lock = threading.Lock()
+_rds_secret = None
+_connection_pools = {}
+_profile_cache = {}
+
+"""Get (and cache) accounts database credentials from AWS Secrets Manager
+"""
+def get_rds_secret():
+  global _rds_secret
+  with _profile_lock:
+    if _rds_secret is None:
+      asm = boto3.client('secretsmanager', region_name=config['aws']['AwsRegionName'])
+      asm_response = asm.get_secret_value(SecretId='rds/accounts_database')
+      _rds_secret = json.loads(asm_response['SecretString'])
+  return _rds_secret
+
+"""Get the shared connection pool for an accounts database
+"""
+def get_connection_pool(db_name=None):
+  db_name = db_name or config['gas']['AccountsDatabase']
+  rds_secret = get_rds_secret()
+  with _profile_lock:
+    if db_name not in _connection_pools:
+      db_uri = "postgresql://" + rds_secret['username'] + ':' + \
+        rds_secret['password'] + '@' + rds_secret['host'] + ':' + \
+        str(rds_secret['port']) + '/' + db_name
+      _connection_pools[db_name] = psycopg2.pool.ThreadedConnectionPool(
+        config.getint('postgres', 'MinConnections'),
+        config.getint('postgres', 'MaxConnections'),
+        db_uri)
+  return _connection_pools[db_name]
+
+"""Drop a user's cached profile, e.g. after their role changes
+"""
+def invalidate_user_profile(id=None, db_name=None):
+  with _profile_lock:
+    _profile_cache.pop((db_name, id), None)
 
 """Access user profile in accounts database
+Profiles are cached for [gas] ProfileCacheTTL seconds. Raises
+ValueError if the identity has no profile.
 """
 def get_user_profile(id=None, db_name=None):
-  # Get database connection details from AWS Secrets Manager
-  asm = boto3.client('secretsmanager', region_name=config['aws']['AwsRegionName'])
-  try:
-    asm_response = asm.get_secret_value(SecretId='rds/accounts_database')
-    rds_secret = json.loads(asm_response['SecretString'])
-  except ClientError as e:
-    raise ClientError
-
-  db_uri = "postgresql://" + rds_secret['username'] + ':' + \
-    rds_secret['password'] + '@' + rds_secret['host'] + ':' + \
-    str(rds_secret['port']) + '/' + \
-    (db_name or config['gas']['AccountsDatabase'])
+  with _profile_lock:
+    cached = _profile_cache.get((db_name, id))
+  if cached and cached[0] > time.time():
+    return cached[1]
 
+  connection_pool = get_connection_pool(db_name)
+  connection = connection_pool.getconn()
   try:
-    # Connect to accounts database and get a cursor
-    connection = psycopg2.connect(db_uri)
-    cursor = connection.cursor(cursor_factory = psycopg2.extras.DictCursor)
-    
     # Query the database and get the user's profile record
-    query_string = f"SELECT * FROM profiles WHERE identity_id = '{id}'"
-    cursor.execute(query_string)
-    profile = cursor.fetchall()[0]
-  
-  except psycopg2.Error as e:
-    connection.rollback()
-    raise psycopg2.Error
+    with connection:
+      cursor = connection.cursor(cursor_factory = psycopg2.extras.DictCursor)
+      cursor.execute("SELECT * FROM profiles WHERE identity_id = %s", (id,))
+      profiles = cursor.fetchall()
+  finally:
+    # Always return the connection, discarding it if the server closed it
+    connection_pool.putconn(connection, close=bool(connection.closed))
+  if not profiles:
+    raise ValueError(f"No user profile for identity {id}")
+  profile = profiles[0]
+
+  with _profile_lock:
+    _profile_cache[(db_name, id)] = (
+      time.time() + config.getint('gas', 'ProfileCacheTTL'), profile)
 
   # Return user profile record as a dict
   return profile
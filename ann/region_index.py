@@ -0,0 +1,68 @@
+# region_index.py
+#
+# Sidecar index for annotated results files: maps coordinate bins and gene
+# symbols to the byte ranges of the variant lines they cover, so region
+# and gene queries can be served with S3 range GETs
+#
+##
+
+import re
+import json
+
+INDEX_VERSION = 1
+GENE_SYMBOL = re.compile(r'(?:^|;)name2=([^;]+)')
+
+
+def normalize_chrom(chrom):
+    return chrom[3:] if chrom.startswith('chr') else chrom
+
+
+def add_range(ranges, start, end):
+    """Append [start, end) to a list of ranges, merging if contiguous"""
+    if ranges and ranges[-1][1] == start:
+        ranges[-1][1] = end
+    else:
+        ranges.append([start, end])
+
+
+def build_index(results_file, index_file, bin_size=100000):
+    """Write the sidecar index for an annotated VCF
+
+    The index is JSON: "bins" maps chromosome (without a "chr" prefix) and
+    bin number (position // bin_size) to byte ranges [start, end), and
+    "genes" maps each gene symbol found in the INFO name2= fields to the
+    byte ranges of its variants. Adjacent lines are merged into a single
+    range, so sorted inputs give one range per bin.
+    """
+    bins = {}
+    genes = {}
+    offset = 0
+    with open(results_file, 'rb') as f:
+        for line in f:
+            start = offset
+            offset += len(line)
+            if line.startswith(b'#'):
+                continue
+            fields = line.decode().split('\t')
+            if len(fields) < 8:
+                continue
+            chrom = normalize_chrom(fields[0].strip())
+            try:
+                bin_number = str(int(fields[1]) // bin_size)
+            except ValueError:
+                continue
+            add_range(bins.setdefault(chrom, {}).setdefault(bin_number, []),
+                start, offset)
+            for symbol in set(GENE_SYMBOL.findall(fields[7])):
+                add_range(genes.setdefault(symbol, []), start, offset)
+
+    with open(index_file, 'w') as f:
+        json.dump({
+            'version': INDEX_VERSION,
+            'bin_size': bin_size,
+            'size': offset,
+            'bins': bins,
+            'genes': genes
+        }, f)
+
+### EOF
@@ -1,11 +1,21 @@
 import sys
 import time
 import driver
+import shards
+import region_index
+from checkpoint import Checkpoint
 import boto3
-from botocore.exceptions import ClientError
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
 import os
 import sys
 import json
+import logging
+import threading
+import zlib
+from decimal import Decimal
+from boto3.exceptions import S3UploadFailedError
+from boto3.s3.transfer import TransferConfig, create_transfer_manager
 
 from flask import (abort, flash, redirect, render_template,
   request, session, url_for)
@@ -33,6 +43,91 @@ class Timer(object):
         if self.verbose:
             print(f"Approximate runtime: {self.secs:.2f} seconds")
 
+# Shared S3 client and transfer manager; boto3 clients are thread safe, so
+# one client serves every transfer, and one manager's MaxConcurrency threads
+# carry the parts of all concurrent uploads and copies. The connection pool
+# is sized to match, so no transfer thread waits for a connection
+MB = 1024 * 1024
+s3_client = boto3.client('s3', region_name = 'us-east-1',
+    config=Config(max_pool_connections=config.getint('TRANSFER', 'MaxConcurrency')))
+transfer_config = TransferConfig(
+    multipart_threshold=config.getint('TRANSFER', 'MultipartThresholdMB') * MB,
+    multipart_chunksize=config.getint('TRANSFER', 'MultipartChunkSizeMB') * MB,
+    max_concurrency=config.getint('TRANSFER', 'MaxConcurrency'),
+    use_threads=True)
+transfer_manager = create_transfer_manager(s3_client, transfer_config)
+
+results_index = boto3.resource('dynamodb').Table(
+    config['CACHE']['ResultsIndexTable'])
+cloudwatch = boto3.client('cloudwatch', region_name = 'us-east-1')
+sqs_client = boto3.client('sqs', region_name = 'us-east-1')
+
+class ProgressReporter(threading.Thread):
+    """Periodically writes annotation progress to the job item
+
+    Progress is observed from outside the pipeline, so the per-variant
+    loops in annotate.py pay nothing for it: the current stage is the
+    number of entries driver.run has put in stage_timings, and progress
+    through that stage is the size of its output file relative to its
+    input. One job_progress write is made at most every interval
+    seconds, and only when something changed.
+    """
+    def __init__(self, table, job_id, input_file_name, stage_timings, interval):
+        threading.Thread.__init__(self, daemon=True)
+        self.table = table
+        self.job_id = job_id
+        self.input_file_name = input_file_name
+        self.stage_timings = stage_timings
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.start_time = time.time()
+        self.last_progress = None
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        with open(self.input_file_name) as f:
+            self.variants_total = sum(1 for line in f if not line.startswith('#'))
+        while not self.stopped.wait(self.interval):
+            self.report()
+
+    def stage_fraction(self, stage):
+        """Approximate fraction of (0-based) stage written so far"""
+        stage_in = self.input_file_name + (f'.{stage}' if stage > 0 else '')
+        stage_out = self.input_file_name + f'.{stage + 1}'
+        try:
+            return min(1.0, os.path.getsize(stage_out) / max(1, os.path.getsize(stage_in)))
+        except OSError:
+            return 0.0
+
+    def report(self):
+        stage = len(self.stage_timings)
+        if stage >= len(driver.STAGES):
+            return
+        fraction = self.stage_fraction(stage)
+        done = (stage + fraction) / len(driver.STAGES)
+        elapsed = time.time() - self.start_time
+        progress = {
+            'stage': driver.STAGES[stage],
+            'stage_number': stage + 1,
+            'stage_count': len(driver.STAGES),
+            'variants_processed': int(fraction * self.variants_total),
+            'variants_total': self.variants_total,
+            'percent_complete': int(done * 100),
+            'eta_seconds': int(elapsed * (1 - done) / done) if done > 0 else -1
+        }
+        if progress == self.last_progress:
+            return
+        try:
+            self.table.update_item(
+                Key={'job_id': self.job_id},
+                UpdateExpression='SET job_progress = :progress',
+                ExpressionAttributeValues={':progress': progress})
+            self.last_progress = progress
+        except ClientError as e:
+            logging.error(e)
+
 def upload_file_to_s3(file_path, bucket, user_id):
     """Upload a file to an S3 bucket
 
@@ -40,16 +135,273 @@ def upload_file_to_s3(file_path, bucket, user_id):
     :param bucket: Bucket to upload to
     :param object_name: S3 object name. If not specified, file_name is used
     """
-    object_name = config['AWS']['AWS_S3_KEY_PREFIX']+ user_id+"/"+ file_path.split('/')[-1]
+    return upload_files_to_s3([file_path], bucket, user_id)
 
-    s3_client = boto3.client('s3', region_name = 'us-east-1')
+def upload_files_to_s3(file_paths, bucket, user_id):
+    """Upload several files to an S3 bucket in parallel
+
+    All uploads are queued on the shared transfer manager at once; each
+    file is itself a multipart upload (per transfer_config), so large
+    results saturate the link while small logs go alongside.
+    Returns True only if every upload succeeded.
+    """
+    futures = [transfer_manager.upload(file_path, bucket,
+        s3_result_key(user_id, file_path)) for file_path in file_paths]
+    uploaded = True
+    for future in futures:
+        try:
+            future.result()
+        except (ClientError, BotoCoreError, S3UploadFailedError) as e:
+            logging.error(e)
+            uploaded = False
+    return uploaded
+
+def lookup_cached_results(input_hash):
+    """Find results of a prior run on identical input, if any
+
+    The results index is keyed on the input's SHA-256 plus the reference
+    and pipeline versions, so a change to either invalidates old entries.
+    """
     try:
-        response = s3_client.upload_file(file_path, bucket, object_name)
+        response = results_index.get_item(
+            Key={'content_key': content_key(input_hash)})
     except ClientError as e:
+        logging.error(e)
+        return None
+    return response.get('Item')
+
+def copy_cached_results(cached, bucket, s3_key_result, s3_key_log, s3_key_index):
+    """Server-side copy of cached results, log and index to this job's keys"""
+    copies = [(cached['s3_key_result_file'], s3_key_result),
+        (cached['s3_key_log_file'], s3_key_log)]
+    # Entries recorded before results were indexed have no sidecar index
+    if 's3_key_index_file' in cached:
+        copies.append((cached['s3_key_index_file'], s3_key_index))
+    try:
+        futures = [transfer_manager.copy({'Bucket': bucket, 'Key': source_key},
+            bucket, target_key) for source_key, target_key in copies]
+        for future in futures:
+            future.result()
+    except (ClientError, BotoCoreError) as e:
+        # Prior results may since have been archived or deleted
         logging.error(e)
         return False
     return True
 
+def record_cached_results(input_hash, job_id, s3_key_result, s3_key_log,
+    s3_key_index):
+    """Add this job's results to the content-addressed results index"""
+    try:
+        results_index.put_item(Item={
+            'content_key': content_key(input_hash),
+            'job_id': job_id,
+            's3_key_result_file': s3_key_result,
+            's3_key_log_file': s3_key_log,
+            's3_key_index_file': s3_key_index,
+        })
+    except ClientError as e:
+        logging.error(e)
+
+def content_key(input_hash):
+    """Results index key for an input hash under the current versions"""
+    return '#'.join([input_hash,
+        config['CACHE']['ReferenceVersion'],
+        config['CACHE']['PipelineVersion']])
+
+def put_metric(name, value, unit='Count'):
+    """Publish a single job metric to CloudWatch"""
+    try:
+        cloudwatch.put_metric_data(
+            Namespace=config['METRICS']['Namespace'],
+            MetricData=[{'MetricName': name, 'Value': value, 'Unit': unit}])
+    except ClientError as e:
+        logging.error(e)
+
+def put_job_timings(timings):
+    """Publish a job's latency breakdown as one metric per phase"""
+    try:
+        cloudwatch.put_metric_data(
+            Namespace=config['METRICS']['Namespace'],
+            MetricData=[{
+                'MetricName': 'JobPhaseLatency',
+                'Dimensions': [{'Name': 'Phase', 'Value': phase}],
+                'Value': float(secs),
+                'Unit': 'Seconds'} for phase, secs in timings.items()])
+    except ClientError as e:
+        logging.error(e)
+
+def as_seconds(secs):
+    """DynamoDB-storable duration, rounded to milliseconds"""
+    return Decimal(str(round(secs, 3)))
+
+def local_result_files(input_file_name):
+    """Local paths of the results and log files driver.run writes for an input"""
+    home_dir = os.path.expanduser('~/mpcs-cc/gas/ann/')
+    file_name_prefix = input_file_name.split('.')[0]
+    return (os.path.join(home_dir, file_name_prefix+'.annot.vcf'),
+        os.path.join(home_dir, input_file_name+ '.count.log'))
+
+def result_index_file(results_file):
+    """Local path of the sidecar region/gene index for a results file"""
+    return results_file + '.idx.json'
+
+def build_result_index(results_file):
+    """Index a finished results file by coordinate bin and gene symbol"""
+    index_file = result_index_file(results_file)
+    region_index.build_index(results_file, index_file,
+        config.getint('INDEX', 'BinSize'))
+    return index_file
+
+def s3_result_key(user_id, file_path):
+    """S3 key under which upload_file_to_s3 stores a local file"""
+    return config['AWS']['AWS_S3_KEY_PREFIX'] + user_id+ '/'+file_path.split('/')[-1]
+
+def archive_shard(job_id):
+    """Archive index partition for a job, stable across retries"""
+    return str(zlib.crc32(job_id.encode()) % config.getint('ARCHIVE', 'IndexShards'))
+
+def complete_shard(table, job_id, parent_job_id, s3_key_result, s3_key_log,
+    worker_id):
+    """Mark a shard sub-job completed and count it against its parent
+
+    The shard's completion and the parent's counter are written in one
+    transaction, conditioned on the shard not being completed already,
+    so a crash or retry can neither lose nor double-count a shard. Once
+    all shards are counted, the reducer is chosen by a conditional write
+    that also takes a lease on the parent (see claim_reduce).
+    """
+    try:
+        table.meta.client.transact_write_items(TransactItems=[
+            {'Update': {
+                'TableName': table.name,
+                'Key': {'job_id': {'S': job_id}},
+                'UpdateExpression': 'SET job_status = :status, complete_time = :complete, s3_key_result_file = :s3_result, s3_key_log_file = :s3_log',
+                'ConditionExpression': 'job_status <> :status',
+                'ExpressionAttributeValues': {
+                    ':status': {'S': 'COMPLETED'},
+                    ':complete': {'N': str(int(time.time()))},
+                    ':s3_result': {'S': s3_key_result},
+                    ':s3_log': {'S': s3_key_log}
+                }}},
+            {'Update': {
+                'TableName': table.name,
+                'Key': {'job_id': {'S': parent_job_id}},
+                'UpdateExpression': 'ADD shards_completed :one',
+                'ExpressionAttributeValues': {':one': {'N': '1'}}}}])
+    except ClientError as e:
+        reasons = e.response.get('CancellationReasons', [])
+        if e.response['Error']['Code'] != 'TransactionCanceledException' or \
+            not reasons or reasons[0].get('Code') != 'ConditionalCheckFailed':
+            raise
+        # Already counted by an earlier attempt of this shard
+    return claim_reduce(table, job_id, parent_job_id, worker_id)
+
+def claim_reduce(table, job_id, parent_job_id, worker_id):
+    """Take the job of merging a parent's shards, once all are counted
+
+    The claim is a lease on the parent (worker_id and lease_expiry, kept
+    alive by renew_lease): it is granted to the first shard in, to a
+    retry of that shard, or to any shard once the lease has expired, and
+    only while the parent is not COMPLETED. Returns the parent item if
+    this worker should reduce, otherwise None.
+    """
+    now = int(time.time())
+    try:
+        response = table.update_item(
+            Key={'job_id': parent_job_id},
+            UpdateExpression='SET shards_reducer = :shard, worker_id = :worker, lease_expiry = :expiry',
+            ConditionExpression='shards_completed = shards_total AND job_status <> :completed AND (attribute_not_exists(shards_reducer) OR shards_reducer = :shard OR lease_expiry < :now)',
+            ExpressionAttributeValues={
+                ':shard': job_id,
+                ':worker': worker_id,
+                ':completed': 'COMPLETED',
+                ':now': now,
+                ':expiry': now + config.getint('LEASE', 'LeaseSeconds')
+            },
+            ReturnValues='ALL_NEW')
+    except ClientError as e:
+        if e.response['Error']['Code'] == "ConditionalCheckFailedException":
+            return None
+        raise
+    return response['Attributes']
+
+def reduce_shards(parent_job_id, shard_count, user_id, input_file_name, bucket):
+    """Merge annotated shards into the parent's local results and log files
+
+    Shard results are concatenated in shard order and the per-shard count
+    logs summed; the shard objects are then removed from S3.
+    """
+    results_file, log_file = local_result_files(input_file_name)
+    shard_files = [local_result_files('download/' +
+        shards.shard_job_id(parent_job_id, shard_index) + '~' +
+        input_file_name.split('~', 1)[1]) for shard_index in range(shard_count)]
+    shard_result_keys = [s3_result_key(user_id, r) for r, _ in shard_files]
+    shard_log_keys = [s3_result_key(user_id, l) for _, l in shard_files]
+
+    shards.concatenate_results(s3_client, bucket, shard_result_keys, results_file)
+    logs = [s3_client.get_object(Bucket=bucket, Key=key)['Body'].read().decode()
+        for key in shard_log_keys]
+    with open(log_file, 'w') as f:
+        f.write(shards.merge_count_logs(logs))
+
+    shard_keys = shard_result_keys + shard_log_keys
+    for i in range(0, len(shard_keys), 1000):
+        s3_client.delete_objects(Bucket=bucket, Delete={
+            'Objects': [{'Key': key} for key in shard_keys[i:i + 1000]]})
+
+def renew_lease(table, job_id, worker_id):
+    """Keep this worker's claim on a running job alive
+
+    Runs in a daemon thread for the life of the process and stops once
+    the job is no longer RUNNING under this worker. The job request
+    message is kept hidden for as long as the lease, so if this worker
+    dies the message reappears and the job resumes elsewhere.
+    """
+    lease = config.getint('LEASE', 'LeaseSeconds')
+    while True:
+        time.sleep(lease / 3)
+        if os.environ.get('JOB_RECEIPT_HANDLE'):
+            try:
+                sqs_client.change_message_visibility(
+                    QueueUrl=os.environ['JOB_QUEUE_URL'],
+                    ReceiptHandle=os.environ['JOB_RECEIPT_HANDLE'],
+                    VisibilityTimeout=lease)
+            except ClientError as e:
+                logging.error(e)
+        try:
+            table.update_item(
+                Key={'job_id': job_id},
+                UpdateExpression='SET lease_expiry = :expiry',
+                ConditionExpression='worker_id = :worker AND job_status = :running',
+                ExpressionAttributeValues={
+                    ':expiry': int(time.time()) + lease,
+                    ':worker': worker_id,
+                    ':running': 'RUNNING'
+                })
+        except ClientError as e:
+            logging.error(e)
+            if e.response['Error']['Code'] == "ConditionalCheckFailedException":
+                return
+
+def delete_job_message():
+    """Remove the job request message once the job is done with it"""
+    if not os.environ.get('JOB_RECEIPT_HANDLE'):
+        return
+    try:
+        sqs_client.delete_message(
+            QueueUrl=os.environ['JOB_QUEUE_URL'],
+            ReceiptHandle=os.environ['JOB_RECEIPT_HANDLE'])
+    except ClientError as e:
+        logging.error(e)
+
+def job_checkpoint(input_file_name, job_id):
+    """Checkpoint for a job's pipeline run, mirrored to S3 if configured"""
+    if config.getboolean('CHECKPOINT', 'S3Checkpoints'):
+        return Checkpoint(input_file_name, job_id, s3=s3_client,
+            bucket=config['AWS']['BucketName'],
+            prefix=config['CHECKPOINT']['S3KeyPrefix'] + job_id + '/')
+    return Checkpoint(input_file_name, job_id)
+
 def cleanup_local_file(file_name):
     """Delete a local file"""
     os.remove(file_name)
@@ -62,48 +414,165 @@ if __name__ == '__main__':
         job_id = sys.argv[2]
         user_email = sys.argv[3]
         user_id = sys.argv[4]
-        with Timer():
-            driver.run(input_file_name, 'vcf')
-        
+        # SHA-256 of the input, computed by the annotator during download
+        input_hash = sys.argv[5] if len(sys.argv) > 5 else None
+        # Shard sub-jobs also get their parent job ID and position
+        parent_job_id = sys.argv[6] if len(sys.argv) > 6 else None
+        # Phases timed so far by the annotator (queue wait, download)
+        timings = {phase: as_seconds(secs) for phase, secs in
+            json.loads(os.environ.get('JOB_TIMINGS', '{}')).items()}
+
         # Define S3 bucket name for results
         bucket_name = config['AWS']['BucketName']
-        
-        # Upload the results file and log file to S3 results bucket
-        home_dir = os.path.expanduser('~/mpcs-cc/gas/ann/')
-        file_name_prefix = input_file_name.split('.')[0]
-
-
-        results_file =  os.path.join(home_dir, file_name_prefix+'.annot.vcf')
-        log_file = os.path.join(home_dir, input_file_name+ '.count.log')
-
+        s3_key_prefix = config['AWS']['AWS_S3_KEY_PREFIX']
 
-        # Assume upload_file_to_s3 modifies these keys as needed
-        upload_file_to_s3(results_file, bucket_name, user_id)
-        upload_file_to_s3(log_file, bucket_name, user_id)
+        results_file, log_file = local_result_files(input_file_name)
+        index_file = result_index_file(results_file)
+        s3_key_result = s3_result_key(user_id, results_file)
+        s3_key_log = s3_result_key(user_id, log_file)
+        s3_key_index = s3_result_key(user_id, index_file)
 
         dynamodb = boto3.resource('dynamodb')
         dynamobName = config['AWS']['DynamodbName']
         table = dynamodb.Table(dynamobName)
+
+        # Renew the lease taken by the annotator for as long as we run
+        if os.environ.get('JOB_WORKER_ID'):
+            threading.Thread(target=renew_lease, daemon=True,
+                args=(table, job_id, os.environ['JOB_WORKER_ID'])).start()
+
+        if parent_job_id:
+            shard_count = int(sys.argv[8])
+            worker_id = os.environ.get('JOB_WORKER_ID', '')
+            shard = table.get_item(Key={'job_id': job_id},
+                ConsistentRead=True).get('Item', {})
+            # A completed shard is only redelivered when its parent was
+            # never merged; skip straight to the reduce
+            if shard.get('job_status') != 'COMPLETED':
+                with Timer():
+                    driver.run(input_file_name, 'vcf',
+                        checkpoint=job_checkpoint(input_file_name, job_id))
+                if not upload_files_to_s3([results_file, log_file], bucket_name, user_id):
+                    print("Error uploading shard results to S3.")
+                    sys.exit(1)
+                cleanup_local_file(results_file)
+                cleanup_local_file(log_file)
+                cleanup_local_file(input_file_name)
+
+            try:
+                parent = complete_shard(table, job_id, parent_job_id,
+                    s3_key_result, s3_key_log, worker_id)
+            except ClientError as e:
+                logging.error(e)
+                print("Error updating DynamoDB item.")
+                sys.exit(1)
+            if not parent:
+                delete_job_message()
+                print(f"Shard {job_id} of job {parent_job_id} completed.")
+                sys.exit(0)
+
+            # Last shard in: merge all shards and complete the parent job.
+            # The shard's message stays hidden under the parent's lease and
+            # is deleted only once the parent is COMPLETED, so a crash
+            # during the merge redelivers it
+            if worker_id:
+                threading.Thread(target=renew_lease, daemon=True,
+                    args=(table, parent_job_id, worker_id)).start()
+            job_id = parent_job_id
+            input_file_name = 'download/' + job_id + '~' + input_file_name.split('~', 1)[1]
+            results_file, log_file = local_result_files(input_file_name)
+            s3_key_result = s3_result_key(user_id, results_file)
+            s3_key_log = s3_result_key(user_id, log_file)
+            timings = dict(parent.get('job_timings', {}))
+            with Timer(verbose=False) as t:
+                reduce_shards(parent_job_id, shard_count, user_id,
+                    input_file_name, bucket_name)
+            timings['merge'] = as_seconds(t.secs)
+            with Timer(verbose=False) as t:
+                index_file = build_result_index(results_file)
+            timings['index'] = as_seconds(t.secs)
+            s3_key_index = s3_result_key(user_id, index_file)
+            with Timer(verbose=False) as t:
+                uploaded = upload_files_to_s3([results_file, log_file, index_file],
+                    bucket_name, user_id)
+            timings['upload'] = as_seconds(t.secs)
+            if not uploaded:
+                print("Error uploading merged results to S3.")
+                sys.exit(1)
+            cache_hit = False
+        else:
+            # Reuse results of an identical earlier input instead of re-annotating
+            cache_hit = False
+            if input_hash:
+                cached = lookup_cached_results(input_hash)
+                if cached:
+                    with Timer(verbose=False) as t:
+                        cache_hit = copy_cached_results(cached, bucket_name,
+                            s3_key_result, s3_key_log, s3_key_index)
+                    timings['cache_copy'] = as_seconds(t.secs)
+            put_metric('ResultCacheHit', int(cache_hit))
+
+            if cache_hit:
+                print(f"Reused results of job {cached['job_id']} for {input_file_name}")
+                if 's3_key_index_file' not in cached:
+                    s3_key_index = None
+            else:
+                stage_timings = {}
+                reporter = ProgressReporter(table, job_id, input_file_name,
+                    stage_timings, config.getint('PROGRESS', 'IntervalSeconds'))
+                reporter.start()
+                with Timer():
+                    driver.run(input_file_name, 'vcf', stage_timings,
+                        job_checkpoint(input_file_name, job_id))
+                reporter.stop()
+                for stage, secs in stage_timings.items():
+                    timings[stage] = as_seconds(secs)
+
+                with Timer(verbose=False) as t:
+                    build_result_index(results_file)
+                timings['index'] = as_seconds(t.secs)
+
+                # Upload results, log and index concurrently over the shared client
+                with Timer(verbose=False) as t:
+                    uploaded = upload_files_to_s3([results_file, log_file, index_file],
+                        bucket_name, user_id)
+                timings['upload'] = as_seconds(t.secs)
+                if not uploaded:
+                    print("Error uploading results to S3.")
+                    sys.exit(1)
+
+                if input_hash:
+                    record_cached_results(input_hash, job_id, s3_key_result,
+                        s3_key_log, s3_key_index)
+
         timestamp = int(time.time())
-        s3_key_prefix = config['AWS']['AWS_S3_KEY_PREFIX']
         # user_id = session['primary_identity']
        
+        update_expression = 'SET s3_key_input_file = :s3_input, s3_key_result_file = :s3_result, job_status = :status, complete_time = :complete, s3_key_log_file = :s3_log, result_cache_hit = :cache_hit, job_timings = :timings'
+        values = {
+            ':s3_input': s3_key_prefix + user_id+ '/' + input_file_name.split('/')[1],
+            ':s3_result': s3_key_result,
+            ':status': 'COMPLETED',
+            ':complete': timestamp,
+            ':s3_log': s3_key_log,
+            ':cache_hit': cache_hit,
+            ':timings': timings
+        }
+        if s3_key_index:
+            update_expression += ', s3_key_index_file = :s3_index'
+            values[':s3_index'] = s3_key_index
 
         try:
-            response = table.update_item(
-            Key={
-                    'job_id': job_id,
-                } ,
-            UpdateExpression='SET s3_key_input_file = :s3_input, s3_key_result_file = :s3_result, job_status = :status, complete_time = :complete, s3_key_log_file = :s3_log',
-            ExpressionAttributeValues={
-                ':s3_input': s3_key_prefix + user_id+ '/' + input_file_name.split('/')[1],
-                ':s3_result': s3_key_prefix + user_id+ '/'+results_file.split('/')[-1],
-                ':status': 'COMPLETED',
-                ':complete': timestamp,
-                ':s3_log': s3_key_prefix + user_id+ '/'+log_file.split('/')[-1]
-            },
-            ReturnValues="UPDATED_NEW"
-        )
+            with Timer(verbose=False) as t:
+                response = table.update_item(
+                Key={
+                        'job_id': job_id,
+                    } ,
+                UpdateExpression=update_expression,
+                ExpressionAttributeValues=values,
+                ReturnValues="UPDATED_NEW"
+            )
+            timings['db_update'] = as_seconds(t.secs)
 
         except ClientError as e:
             logging.error(e)
@@ -113,6 +582,7 @@ if __name__ == '__main__':
         sns_client = boto3.client('sns', region_name = 'us-east-1')
         message = json.dumps({"default": json.dumps({"job_id": job_id, "email":user_email})})  
         topic_arn = config['AWS']['SNS_Result_ARN']
+        notify_start = time.time()
         try:
             response = sns_client.publish(
                 TopicArn=topic_arn,
@@ -127,31 +597,43 @@ if __name__ == '__main__':
             print(f"An error occurred: {e}")
         except Exception as e:
             print(f"An unexpected error occurred: {e}")
+        timings['notification'] = as_seconds(time.time() - notify_start)
 
-        _, _, _, _, role, _, _ = helpers.get_user_profile(id=user_id) # get user role, if free_user, send message to queue
-        print(role)
-        if role == 'free_user': 
-            sqs = boto3.resource('sqs')
-            archive_queue_name = config['AWS']['Archive_Queue_Name']
-            queue = sqs.get_queue_by_name(QueueName = archive_queue_name)
-            queue.send_message(
-                MessageBody=str({
-                    'user_id': user_id, 
-                    'job_id': job_id, 
-                    's3_key_result_file': s3_key_prefix + user_id+ '/'+results_file.split('/')[-1]})
-            )
-            print("send archive message sucessfully")
-        else: 
-            pass
-
-
+        # Record the phases that finished after the completion update
+        try:
+            table.update_item(
+                Key={'job_id': job_id},
+                UpdateExpression='SET job_timings.db_update = :db_update, job_timings.notification = :notification',
+                ExpressionAttributeValues={
+                    ':db_update': timings['db_update'],
+                    ':notification': timings['notification']
+                })
+        except ClientError as e:
+            logging.error(e)
+        put_job_timings(timings)
 
+        # Free users' results go in the archive index, which util/archive
+        # sweeps for jobs past their retention. Only after the job is
+        # COMPLETED, so an accounts database failure cannot fail the job
+        try:
+            _, _, _, _, role, _, _ = helpers.get_user_profile(id=user_id)
+            if role == 'free_user':
+                table.update_item(
+                    Key={'job_id': job_id},
+                    UpdateExpression='SET archive_shard = :archive_shard',
+                    ExpressionAttributeValues={':archive_shard': archive_shard(job_id)})
+        except Exception as e:
+            logging.error(f"Unable to queue job {job_id} for archival: {e}")
 
+        delete_job_message()
 
         # Cleanup local files
-        cleanup_local_file(results_file)
-        cleanup_local_file(log_file)
-        cleanup_local_file(input_file_name)
+        if not cache_hit:
+            cleanup_local_file(results_file)
+            cleanup_local_file(log_file)
+            cleanup_local_file(index_file)
+        if not parent_job_id:
+            cleanup_local_file(input_file_name)
         
         print(f"Results and log files for {input_file_name} have been uploaded to S3 and local copies deleted.")
         pass
@@ -0,0 +1,126 @@
+# shards.py
+#
+# Map-reduce support for very large VCF inputs: split an S3 object into
+# line-aligned byte-range shards, fetch a shard for annotation, and
+# reassemble the annotated shards and their count logs
+#
+##
+
+import re
+
+READ_WINDOW = 64 * 1024
+
+
+def read_range(s3, bucket, key, start, end):
+    """Read bytes [start, end] (inclusive) of an S3 object"""
+    response = s3.get_object(Bucket=bucket, Key=key, Range=f'bytes={start}-{end}')
+    return response['Body'].read()
+
+
+def find_header_end(s3, bucket, key, size):
+    """Byte offset of the first line that is not a '#' header line"""
+    buffer = b''
+    offset = 0
+    while True:
+        # Extend the buffer until the line starting at offset is complete
+        newline = buffer.find(b'\n', offset)
+        if newline < 0:
+            if len(buffer) >= size:
+                return size
+            buffer += read_range(s3, bucket, key, len(buffer),
+                min(len(buffer) + READ_WINDOW, size) - 1)
+            continue
+        if not buffer.startswith(b'#', offset):
+            return offset
+        offset = newline + 1
+
+
+def find_next_line(s3, bucket, key, offset, size):
+    """Byte offset of the first line starting after offset"""
+    while offset < size:
+        window = read_range(s3, bucket, key, offset,
+            min(offset + READ_WINDOW, size) - 1)
+        newline = window.find(b'\n')
+        if newline >= 0:
+            return offset + newline + 1
+        offset += len(window)
+    return size
+
+
+def plan_shards(s3, bucket, key, size, shard_size):
+    """Split an S3 VCF object into line-aligned byte ranges
+
+    Returns (header_end, ranges) where header_end is the length of the
+    '#' header block and ranges is a list of inclusive (start, end) byte
+    ranges covering the variant lines, each roughly shard_size bytes.
+    Only small windows around each boundary are read from S3.
+    """
+    header_end = find_header_end(s3, bucket, key, size)
+    ranges = []
+    start = header_end
+    while start < size:
+        end = find_next_line(s3, bucket, key, start + shard_size, size)
+        ranges.append((start, end - 1))
+        start = end
+    return header_end, ranges
+
+
+def download_shard(s3, bucket, key, header_end, byte_range, local_file_path,
+    chunk_size=1024 * 1024):
+    """Write the VCF header plus one byte range of an S3 object to a file"""
+    with open(local_file_path, 'wb') as f:
+        if header_end > 0:
+            f.write(read_range(s3, bucket, key, 0, header_end - 1))
+        response = s3.get_object(Bucket=bucket, Key=key,
+            Range=f'bytes={byte_range[0]}-{byte_range[1]}')
+        for chunk in response['Body'].iter_chunks(chunk_size):
+            f.write(chunk)
+
+
+def shard_job_id(parent_job_id, shard_index):
+    return f'{parent_job_id}_{shard_index:04d}'
+
+
+def concatenate_results(s3, bucket, shard_keys, local_file_path):
+    """Concatenate annotated shards, in order, into one results file
+
+    The header is taken from the first shard only.
+    """
+    with open(local_file_path, 'wb') as f:
+        for index, key in enumerate(shard_keys):
+            body = s3.get_object(Bucket=bucket, Key=key)['Body']
+            for line in body.iter_lines(keepends=True):
+                if index > 0 and line.startswith(b'#'):
+                    continue
+                f.write(line)
+
+
+INTEGER = re.compile(r'(?<![\w\'.])\d+(?![\w.%])')
+DBSNP_LINE = re.compile(r'^In dbSNP: (\d+) \([\d.]+%\)$')
+
+
+def merge_count_logs(logs):
+    """Sum the statistics of per-shard .count.log files
+
+    Every shard runs the same stages, so the logs line up; integer counts
+    on matching lines are added and the dbSNP ratio is recomputed from
+    the summed totals. The baseline's Total starts counting at 1, so the
+    extra 1 of every shard but the first is taken off the summed Total.
+    """
+    merged = []
+    total = 0
+    for lines in zip(*[log.splitlines() for log in logs]):
+        counts = [[int(n) for n in INTEGER.findall(line)] for line in lines]
+        sums = iter([sum(column) for column in zip(*counts)])
+        line = INTEGER.sub(lambda match: str(next(sums)), lines[0])
+        if line.startswith('Total: '):
+            total = int(line.split()[1]) - (len(logs) - 1)
+            line = f"Total: {total}"
+        dbsnp = DBSNP_LINE.match(line)
+        if dbsnp and total:
+            in_dbsnp = int(dbsnp.group(1))
+            line = f"In dbSNP: {in_dbsnp} ({(in_dbsnp / float(total)) * 100}%)"
+        merged.append(line)
+    return '\n'.join(merged) + '\n'
+
+### EOF
@@ -9,101 +9,350 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import os
 import sys
+import time
 import boto3
-import json
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from botocore.exceptions import ClientError
 import botocore.exceptions as exceptions 
 
 
 # Import utility helpers
-sys.path.insert(1, os.path.realpath(os.path.pardir))
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import helpers
+import treehash
+import compression
+import sweeper
+import clients
 
 # Get configuration
 from configparser import SafeConfigParser
 config = SafeConfigParser(os.environ)
-config.read('archive_config.ini')
+config.read(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'archive_config.ini'))
 
 # Add utility code here
-s3 = boto3.client('s3')
-dynamodb = boto3.client('dynamodb')
-sqs = boto3.client('sqs')
-glacier = boto3.client('glacier')
+s3 = clients.client('s3')
+dynamodb = clients.client('dynamodb')
+glacier = clients.client('glacier')
 
-def main():
-    print('....Move files to glacier...')
-    while True:
-        # If the user is free_user, the run.py will send out the message to queue
-        response = sqs.receive_message(
-            QueueUrl=config['aws']['ArchiveQueueUrl'], 
-            MaxNumberOfMessages=1, 
-            WaitTimeSeconds=20)
-        print("Receive message sucessfully")
+def read_part(body, size):
+    """Read up to size bytes from a streaming body, short only at the end"""
+    chunks = []
+    remaining = size
+    while remaining > 0:
+        chunk = body.read(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
 
+def upload_part(vault, upload_id, offset, data, checksum):
+    glacier.upload_multipart_part(
+        vaultName=vault,
+        uploadId=upload_id,
+        range=f'bytes {offset}-{offset + len(data) - 1}/*',
+        checksum=checksum,
+        body=data)
 
-        try:
-            message = response['Messages'][0]
-            message_body = message['Body']
-            receipt_handle = message['ReceiptHandle']
-            
-        except KeyError: # queue is empty
-            continue
-
-        fixed_json_string = message_body.replace("'", '"')
-        message_body_dict = json.loads(fixed_json_string)
-        user_id = message_body_dict['user_id']
-        job_id = message_body_dict['job_id']
-        s3_key_result_file = message_body_dict['s3_key_result_file']
-        print(job_id)
-        _, _, _, _, role, _, _ = helpers.get_user_profile(id=user_id) # Shitty utility return value
-        if role == 'premium_user':   # in case free_user update to premium user
-            sqs.delete_message(
-                QueueUrl=config['aws']['ArchiveQueueUrl'], 
-                ReceiptHandle=receipt_handle)
-            continue
-        
-        try:
-            response = s3.get_object(
+class ObjectsBody(object):
+    """Readable stream over several S3 objects, one after another
+
+    Each object is opened only when the previous one is exhausted. With
+    a codec, each object is compressed as its own stream, so any one of
+    them can later be cut out of the archive and decompressed alone;
+    sizes lists the number of bytes each object contributed.
+    """
+    def __init__(self, keys, codec=None):
+        self.keys = list(keys)
+        self.codec = codec
+        self.body = None
+        self.compressor = None
+        self.pending = bytearray()
+        self.sizes = []
+
+    def read(self, size):
+        while len(self.pending) < size and self.fill():
+            pass
+        data = bytes(self.pending[:size])
+        del self.pending[:size]
+        return data
+
+    def fill(self):
+        """Add the next piece of output to pending; False at the end"""
+        if self.body is None:
+            if not self.keys:
+                return False
+            self.body = s3.get_object(
                 Bucket=config['aws']['AWS_S3_RESULTS_BUCKET'],
-                Key=s3_key_result_file)
-            result_file_object = response['Body'].read()
-        except exceptions.ClientError as e: 
-            print(f"{e}\nBucket:{config['aws']['AWS_S3_RESULTS_BUCKET']}\nKey:{s3_key_result_file}")
-            continue
-        
-        
-        try:
+                Key=self.keys.pop(0))['Body']
+            self.compressor = compression.compressor(self.codec) if self.codec else None
+            self.sizes.append(0)
+        data = self.body.read(treehash.MB)
+        if data:
+            output = self.compressor.compress(data) if self.compressor else data
+        else:
+            output = self.compressor.flush() if self.compressor else b''
+            self.close()
+        self.sizes[-1] += len(output)
+        self.pending += output
+        return True
+
+    def close(self):
+        if self.body is not None:
+            self.body.close()
+            self.body = None
+
+def archive_codec():
+    """Codec results are compressed with before archival, or None"""
+    codec = config['archive']['Codec']
+    if codec == 'none':
+        return None
+    if codec not in compression.CODECS:
+        raise ValueError(f'Unknown archive Codec {codec}')
+    return codec
+
+def archive_results(s3_key_result_files, description=None):
+    """Stream one or more results files from S3 into a Glacier archive
+
+    The files are stored back to back, each compressed with codec if
+    one is given. Archives up to one part go up with upload_archive;
+    larger ones are read a part at a time and sent as a multipart
+    upload, with up to UploadConcurrency parts in flight. Each part's
+    tree hash is computed as it is read and the archive's is combined
+    from them, so memory use is bounded by the part size, not the file
+    size. Returns the archive ID and the stored size of each file.
+    """
+    vault = config['aws']['AWS_S3_Glacier_Bucket_Name']
+    part_size = config.getint('archive', 'PartSizeMB') * treehash.MB
+    concurrency = config.getint('archive', 'UploadConcurrency')
+    # The job ID in the description lets thaw find the job directly
+    described = {'archiveDescription': description} if description else {}
+
+    body = ObjectsBody(s3_key_result_files, archive_codec())
+    try:
+        # The stored size is only known once the files are read, so the
+        # first part decides between a single and a multipart upload
+        data = read_part(body, part_size)
+        if len(data) < part_size:
             response = glacier.upload_archive(
-                vaultName=config['aws']['AWS_S3_Glacier_Bucket_Name'],
-                body=result_file_object
-            )
-            location, archive_id = response['location'], response['archiveId']
-            print(f"Archive uploaded successfully: {archive_id} at {location}")
+                vaultName=vault,
+                body=data,
+                **described)
+            return response['archiveId'], body.sizes
+
+        upload_id = glacier.initiate_multipart_upload(
+            vaultName=vault,
+            partSize=str(part_size),
+            **described)['uploadId']
+        try:
+            leaves = []
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                in_flight = set()
+                offset = 0
+                while data:
+                    part_hash = treehash.TreeHash(data)
+                    leaves.extend(part_hash.leaves())
+                    if len(in_flight) >= concurrency:
+                        done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            future.result()
+                    in_flight.add(executor.submit(upload_part, vault, upload_id,
+                        offset, data, part_hash.hexdigest()))
+                    offset += len(data)
+                    data = read_part(body, part_size)
+                for future in in_flight:
+                    future.result()
+            response = glacier.complete_multipart_upload(
+                vaultName=vault,
+                uploadId=upload_id,
+                archiveSize=str(offset),
+                checksum=treehash.combine(leaves).hex())
+            return response['archiveId'], body.sizes
+        except Exception:
+            glacier.abort_multipart_upload(vaultName=vault, uploadId=upload_id)
+            raise
+    finally:
+        body.close()
+
+def clear_archive_due(job_ids):
+    """Take jobs out of the archive index without archiving them"""
+    for job_id in job_ids:
+        dynamodb.update_item(
+            TableName=config['aws']['DynamodbName'],
+            Key={'job_id': {'S': job_id}},
+            UpdateExpression='REMOVE archive_shard')
+
+def is_premium(user_id):
+    _, _, _, _, role, _, _ = helpers.get_user_profile(id=user_id) # Shitty utility return value
+    return role == 'premium_user'
+
+def archive_job(job_id, s3_key_result_file):
+    """Archive one job's results as its own Glacier archive
+
+    Returns True once the results are archived.
+    """
+    try:
+        archive_id, sizes = archive_results([s3_key_result_file], job_id)
+        print(f"Archive uploaded successfully: {archive_id}")
+    except ClientError as e:
+        print(f"{e}\nBucket:{config['aws']['AWS_S3_RESULTS_BUCKET']}\nKey:{s3_key_result_file}")
+        return False
+    except IOError as e:
+        print(f"An error occurred during upload: {e}")
+        return False
+
+    # Update databse with arichive id; the job leaves the archive index
+    dynamodb.update_item(
+            TableName=config['aws']['DynamodbName'],
+            Key={'job_id': {'S': job_id}}, 
+            ExpressionAttributeValues={
+                ':id': {'S': archive_id},
+                ':size': {'N': str(sizes[0])},
+                ':codec': {'S': archive_codec() or 'none'}
+            }, 
+            UpdateExpression='SET results_file_archive_id = :id, results_file_archive_size = :size, results_file_archive_codec = :codec REMOVE s3_key_result_file, archive_shard'
+        )
+    
+    # delete results file from s3
+    s3.delete_object(
+            Bucket=config['aws']['AWS_S3_RESULTS_BUCKET'],
+            Key=s3_key_result_file)
+    return True
+
+def archive_bundle(jobs):
+    """Pack several of one user's results into a single Glacier archive
+
+    jobs is a list of (job_id, s3_key_result_file). Each job item gets
+    the bundle's archive ID plus its byte offset and length within the
+    bundle (and the bundle size), which is the bundle's index: restore
+    retrieves just those byte ranges.
+    """
+    # Results already archived by an earlier, interrupted run are gone
+    present = []
+    for job in jobs:
+        try:
+            s3.head_object(Bucket=config['aws']['AWS_S3_RESULTS_BUCKET'], Key=job[1])
+            present.append(job)
         except ClientError as e:
-            print(f"An error occurred during upload: {e.response['Error']['Message']}")
-            continue
+            if e.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+                print(e)
+                return
+            clear_archive_due([job[0]])
+    if not present:
+        return
 
-        # Update databse with arichive id
+    try:
+        archive_id, sizes = archive_results([key for _, key in present])
+        print(f"Bundle of {len(present)} results uploaded successfully: {archive_id}")
+    except ClientError as e:
+        print(f"An error occurred during bundle upload: {e}")
+        return
+    except IOError as e:
+        print(f"An error occurred during bundle upload: {e}")
+        return
+
+    offset = 0
+    for (job_id, _), size in zip(present, sizes):
         dynamodb.update_item(
-                TableName=config['aws']['DynamodbName'],
-                Key={'job_id': {'S': job_id}}, 
-                ExpressionAttributeValues={
-                    ':id': {'S': archive_id}
-                }, 
-                UpdateExpression='SET results_file_archive_id = :id REMOVE s3_key_result_file'
-            )
-        
-        # delete results file from s3
-        s3.delete_object(
-                Bucket=config['aws']['AWS_S3_RESULTS_BUCKET'],
-                Key=s3_key_result_file)
+            TableName=config['aws']['DynamodbName'],
+            Key={'job_id': {'S': job_id}},
+            ExpressionAttributeValues={
+                ':id': {'S': archive_id},
+                ':offset': {'N': str(offset)},
+                ':length': {'N': str(size)},
+                ':size': {'N': str(sum(sizes))},
+                ':codec': {'S': archive_codec() or 'none'}
+            },
+            UpdateExpression='SET results_file_archive_id = :id, archive_bundle_offset = :offset, archive_bundle_length = :length, archive_bundle_size = :size, results_file_archive_codec = :codec REMOVE s3_key_result_file, archive_shard')
+        offset += size
 
-        # delete message from archive queue
-        sqs.delete_message(
-                QueueUrl=config['aws']['ArchiveQueueUrl'], 
-                ReceiptHandle=receipt_handle)
+    keys = [key for _, key in present]
+    for i in range(0, len(keys), 1000):
+        s3.delete_objects(
+            Bucket=config['aws']['AWS_S3_RESULTS_BUCKET'],
+            Delete={'Objects': [{'Key': key} for key in keys[i:i + 1000]]})
+
+def due_jobs():
+    """Jobs whose retention has lapsed, grouped by user
+
+    run.py puts each free user's completed job in the archive index: the
+    sparse GSI IndexName, keyed on archive_shard (one of IndexShards
+    values, spreading the writes) and complete_time. Each shard is
+    queried for jobs completed between LookbackSeconds before the
+    retention cutoff and the cutoff itself, up to MaxJobsPerSweep in all.
+    """
+    cutoff = int(time.time()) - config.getint('archive', 'RetentionSeconds')
+    limit = config.getint('archive', 'MaxJobsPerSweep')
+    jobs = {}
+    count = 0
+    for shard in range(config.getint('archive', 'IndexShards')):
+        query = {
+            'TableName': config['aws']['DynamodbName'],
+            'IndexName': config['archive']['IndexName'],
+            'KeyConditionExpression': 'archive_shard = :shard AND complete_time BETWEEN :oldest AND :cutoff',
+            'ExpressionAttributeValues': {
+                ':shard': {'S': str(shard)},
+                ':oldest': {'N': str(cutoff - config.getint('archive', 'LookbackSeconds'))},
+                ':cutoff': {'N': str(cutoff)}
+            },
+            'ProjectionExpression': 'job_id, user_id, s3_key_result_file'
+        }
+        while count < limit:
+            response = dynamodb.query(**query)
+            for item in response['Items'][:limit - count]:
+                if 's3_key_result_file' not in item:
+                    clear_archive_due([item['job_id']['S']])
+                    continue
+                jobs.setdefault(item['user_id']['S'], []).append(
+                    (item['job_id']['S'], item['s3_key_result_file']['S']))
+                count += 1
+            if 'LastEvaluatedKey' not in response:
+                break
+            query['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    return jobs
+
+def archive_user_jobs(user_id, jobs, stopped):
+    """Archive one user's due jobs, bundled unless Mode = single"""
+    if stopped.is_set():
+        return
+    if is_premium(user_id):   # in case free_user update to premium user
+        clear_archive_due([job_id for job_id, _ in jobs])
+        return
+    if config['archive']['Mode'] != 'bundle':
+        for job_id, s3_key_result_file in jobs:
+            if stopped.is_set():
+                return
+            archive_job(job_id, s3_key_result_file)
+        return
+    max_files = config.getint('archive', 'BundleMaxFiles')
+    for i in range(0, len(jobs), max_files):
+        if stopped.is_set():
+            return
+        archive_bundle(jobs[i:i + max_files])
+
+def sweep(stopped):
+    """Archive every due job, up to SweepConcurrency users at a time"""
+    jobs = due_jobs()
+    if not jobs:
+        return
+    print(f"Archiving {sum(len(user_jobs) for user_jobs in jobs.values())} results of {len(jobs)} users")
+    with ThreadPoolExecutor(max_workers=config.getint('archive', 'SweepConcurrency')) as executor:
+        futures = [executor.submit(archive_user_jobs, user_id, user_jobs, stopped)
+            for user_id, user_jobs in jobs.items()]
+    for future in futures:
+        future.result()
+
+def make_consumer(metrics=None):
+    archive_codec() # Fail at startup on a misconfigured Codec
+    # run.py puts free users' completed jobs in the archive index
+    return sweeper.Sweeper('archive', sweep,
+        config.getint('archive', 'SweepIntervalSeconds'), metrics=metrics)
+
+def main():
+    print('....Move files to glacier...')
+    make_consumer().run()
 
 if __name__ == '__main__': 
     main()
 
-### EOF
\ No newline at end of file
+### EOF
@@ -0,0 +1,35 @@
+# clients.py
+#
+# AWS clients shared by every utility daemon in a process
+#
+##
+
+import os
+import threading
+
+import boto3
+from botocore.config import Config
+
+# Get util configuration
+from configparser import SafeConfigParser
+config = SafeConfigParser(os.environ)
+config.read(os.path.join(os.path.abspath(os.path.dirname(__file__)), 'util_config.ini'))
+
+clients = {}
+clients_lock = threading.Lock()
+
+
+"""Get the process-wide client for an AWS service
+boto3 clients are thread safe, so one client per service (and its
+connection pool, sized by MaxPoolConnections) serves every daemon and
+worker thread hosted in the process.
+"""
+def client(service_name):
+  with clients_lock:
+    if service_name not in clients:
+      clients[service_name] = boto3.client(service_name,
+        region_name=config['aws']['AwsRegionName'],
+        config=Config(max_pool_connections=config.getint('aws', 'MaxPoolConnections')))
+    return clients[service_name]
+
+### EOF
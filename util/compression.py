@@ -0,0 +1,49 @@
+# compression.py
+#
+# Stream codecs for archived results
+#
+##
+
+import lzma
+import zlib
+
+CODECS = ('gzip', 'lzma')
+
+
+"""Incremental compressor for a codec: compress(data) and flush()
+gzip writes a gzip member (zlib with a gzip header), lzma an .xz stream.
+"""
+def compressor(codec):
+  if codec == 'gzip':
+    return zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+  if codec == 'lzma':
+    return lzma.LZMACompressor(format=lzma.FORMAT_XZ)
+  raise ValueError(f'Unknown codec {codec}')
+
+
+"""Incremental decompressor for a codec: decompress(data) and flush()
+eof is True once the end of the compressed stream has been read.
+"""
+class Decompressor(object):
+  def __init__(self, codec):
+    if codec == 'gzip':
+      self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif codec == 'lzma':
+      self.decompressor = lzma.LZMADecompressor(format=lzma.FORMAT_XZ)
+    else:
+      raise ValueError(f'Unknown codec {codec}')
+
+  def decompress(self, data):
+    return self.decompressor.decompress(data)
+
+  def flush(self):
+    # LZMADecompressor returns everything from decompress()
+    if hasattr(self.decompressor, 'flush'):
+      return self.decompressor.flush()
+    return b''
+
+  @property
+  def eof(self):
+    return self.decompressor.eof
+
+### EOF
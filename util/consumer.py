@@ -0,0 +1,165 @@
+# consumer.py
+#
+# Concurrent SQS consumer shared by the utility daemons
+#
+##
+
+import time
+import signal
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+import clients
+
+
+"""Receive messages from an SQS queue and handle them concurrently
+handler(message) is called on a pool of `concurrency` threads with each
+message as returned by receive_message; it returns True when the
+message should be deleted, or False to leave it for redelivery (or
+because the handler deletes it itself later). Messages are received in
+batches of up to ten, and only as many as there are free workers, so
+none sit in memory with their visibility timeout running.
+
+Messages are received with `visibility_timeout`, and while a message is
+being handled its visibility is extended again every third of that
+(change_message_visibility_batch), so long handlers are never
+redelivered mid-way. Handled messages are deleted ten at a time with
+delete_message_batch, or sooner once the oldest has waited
+`delete_delay` seconds.
+
+tick(), if given, is called from the receiving thread about once per
+receive, for work that is due periodically rather than per message.
+stop() (or SIGINT/SIGTERM when run() is called from the main thread)
+stops receiving; run() returns once in-flight messages are handled and
+deleted. If metrics is given, each message's handling time (and
+whether it raised) is recorded under the consumer's name.
+"""
+class Consumer(object):
+  def __init__(self, name, queue_url, handler, concurrency=1, tick=None,
+    wait_time=20, metrics=None, visibility_timeout=300, delete_delay=1):
+    self.name = name
+    self.queue_url = queue_url
+    self.handler = handler
+    self.concurrency = concurrency
+    self.tick = tick
+    self.wait_time = wait_time
+    self.metrics = metrics
+    self.visibility_timeout = visibility_timeout
+    self.delete_delay = delete_delay
+    self.sqs = clients.client('sqs')
+    self.stopped = threading.Event()
+    self.deletions = []
+    self.oldest_deletion = None
+    self.deletions_lock = threading.Lock()
+    # Receipt handles of messages being handled
+    self.handling = set()
+    self.handling_lock = threading.Lock()
+    self.last_heartbeat = time.time()
+
+  def stop(self, *args):
+    self.stopped.set()
+
+  def handle(self, message):
+    start = time.time()
+    error = False
+    try:
+      if self.handler(message):
+        with self.deletions_lock:
+          if not self.deletions:
+            self.oldest_deletion = time.time()
+          self.deletions.append(message['ReceiptHandle'])
+    except Exception:
+      # Leave the message to be redelivered; keep the worker alive
+      logging.exception(f"{self.name}: error handling message {message.get('MessageId')}")
+      error = True
+    finally:
+      with self.handling_lock:
+        self.handling.discard(message['ReceiptHandle'])
+    if self.metrics:
+      self.metrics.record(self.name, time.time() - start, error)
+
+  def heartbeat(self):
+    """Extend the visibility of messages still being handled"""
+    if time.time() - self.last_heartbeat < self.visibility_timeout / 3:
+      return
+    self.last_heartbeat = time.time()
+    with self.handling_lock:
+      handles = list(self.handling)
+    for i in range(0, len(handles), 10):
+      try:
+        response = self.sqs.change_message_visibility_batch(
+          QueueUrl=self.queue_url,
+          Entries=[{'Id': str(n), 'ReceiptHandle': handle,
+            'VisibilityTimeout': self.visibility_timeout}
+            for n, handle in enumerate(handles[i:i + 10])])
+        for failure in response.get('Failed', []):
+          logging.error(f"{self.name}: unable to extend visibility: {failure}")
+      except (ClientError, BotoCoreError) as e:
+        logging.error(f"{self.name}: unable to extend visibility: {e}")
+
+  def flush_deletions(self, force=False):
+    with self.deletions_lock:
+      if not self.deletions:
+        return
+      if len(self.deletions) < 10 and not force and \
+        time.time() - self.oldest_deletion < self.delete_delay:
+        return
+      handles, self.deletions = self.deletions, []
+    for i in range(0, len(handles), 10):
+      try:
+        response = self.sqs.delete_message_batch(
+          QueueUrl=self.queue_url,
+          Entries=[{'Id': str(n), 'ReceiptHandle': handle}
+            for n, handle in enumerate(handles[i:i + 10])])
+        for failure in response.get('Failed', []):
+          logging.error(f"{self.name}: unable to delete message: {failure}")
+      except (ClientError, BotoCoreError) as e:
+        logging.error(f"{self.name}: unable to delete messages: {e}")
+
+  def run(self):
+    if threading.current_thread() is threading.main_thread():
+      signal.signal(signal.SIGINT, self.stop)
+      signal.signal(signal.SIGTERM, self.stop)
+
+    in_flight = set()
+    with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+      while not self.stopped.is_set():
+        self.heartbeat()
+        if len(in_flight) >= self.concurrency:
+          _, in_flight = wait(in_flight, timeout=1, return_when=FIRST_COMPLETED)
+          self.flush_deletions()
+          if self.tick:
+            self.tick()
+          continue
+        try:
+          response = self.sqs.receive_message(
+            QueueUrl=self.queue_url,
+            MaxNumberOfMessages=min(10, self.concurrency - len(in_flight)),
+            VisibilityTimeout=self.visibility_timeout,
+            # Return promptly while other messages are being handled, so
+            # their deletions and heartbeats are not held up by the long poll
+            WaitTimeSeconds=1 if in_flight else self.wait_time)
+        except (ClientError, BotoCoreError) as e:
+          logging.error(f"{self.name}: unable to receive messages: {e}")
+          self.stopped.wait(self.wait_time)
+          continue
+        for message in response.get('Messages', []):
+          with self.handling_lock:
+            self.handling.add(message['ReceiptHandle'])
+          in_flight.add(executor.submit(self.handle, message))
+        in_flight = {future for future in in_flight if not future.done()}
+        self.flush_deletions(force=not in_flight)
+        if self.tick:
+          self.tick()
+
+      # Keep extending visibility while the last messages finish
+      while in_flight:
+        _, in_flight = wait(in_flight, timeout=1, return_when=FIRST_COMPLETED)
+        self.heartbeat()
+        self.flush_deletions()
+    self.flush_deletions(force=True)
+
+### EOF
@@ -0,0 +1,66 @@
+# host.py
+#
+# Runs the utility daemons (archive, restore, thaw) as plug-ins of one
+# process, sharing AWS clients, the accounts database pool and a metrics
+# exporter
+#
+# Usage: python host.py [daemon ...]  (default: [host] Daemons)
+##
+
+import os
+import sys
+import signal
+import logging
+import importlib
+import threading
+
+sys.path.insert(1, os.path.dirname(os.path.abspath(__file__)))
+from metrics import Metrics
+
+# Get util configuration
+from configparser import SafeConfigParser
+config = SafeConfigParser(os.environ)
+config.read(os.path.join(os.path.abspath(os.path.dirname(__file__)), 'util_config.ini'))
+
+
+"""Load a daemon plug-in: util/<name>/<name>.py, which provides
+make_consumer(metrics) returning its consumer.Consumer (or, for
+scheduled daemons, sweeper.Sweeper)
+"""
+def load_daemon(name):
+  return importlib.import_module(f'{name}.{name}')
+
+
+def main():
+  logging.basicConfig(level=config['host']['LogLevel'],
+    format='%(asctime)s %(threadName)s %(levelname)s %(message)s')
+  names = sys.argv[1:] or \
+    [name.strip() for name in config['host']['Daemons'].split(',') if name.strip()]
+
+  metrics = Metrics()
+  consumers = [load_daemon(name).make_consumer(metrics) for name in names]
+
+  def stop(*args):
+    logging.info('Stopping daemons')
+    for consumer in consumers:
+      consumer.stop()
+  signal.signal(signal.SIGINT, stop)
+  signal.signal(signal.SIGTERM, stop)
+
+  metrics.start()
+  threads = [threading.Thread(target=consumer.run, name=consumer.name)
+    for consumer in consumers]
+  for thread in threads:
+    thread.start()
+  logging.info(f"Hosting {', '.join(names)}")
+  # Join with a timeout so the main thread keeps handling signals
+  for thread in threads:
+    while thread.is_alive():
+      thread.join(1)
+  metrics.stop()
+
+
+if __name__ == '__main__':
+  main()
+
+### EOF
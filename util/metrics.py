@@ -0,0 +1,85 @@
+# metrics.py
+#
+# Per-daemon message metrics, exported to CloudWatch from one thread
+#
+##
+
+import os
+import time
+import logging
+import threading
+
+from botocore.exceptions import ClientError
+
+import clients
+
+# Get util configuration
+from configparser import SafeConfigParser
+config = SafeConfigParser(os.environ)
+config.read(os.path.join(os.path.abspath(os.path.dirname(__file__)), 'util_config.ini'))
+
+
+"""Message counts and handling latency for the daemons in a process
+Consumers call record() for each message they handle; a background
+thread publishes, every IntervalSeconds, each daemon's message rate,
+error count and latency statistics under the Daemon dimension, then
+starts a new interval.
+"""
+class Metrics(object):
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.stats = {}
+    self.started = time.time()
+    self.stopped = threading.Event()
+
+  def record(self, daemon, seconds, error=False):
+    with self.lock:
+      stats = self.stats.setdefault(daemon,
+        {'messages': 0, 'errors': 0, 'latencies': []})
+      stats['messages'] += 1
+      stats['errors'] += int(error)
+      stats['latencies'].append(seconds)
+
+  def start(self):
+    threading.Thread(target=self.run, daemon=True).start()
+
+  def stop(self):
+    self.stopped.set()
+    self.export()
+
+  def run(self):
+    while not self.stopped.wait(config.getint('metrics', 'IntervalSeconds')):
+      self.export()
+
+  def export(self):
+    with self.lock:
+      stats, self.stats = self.stats, {}
+      elapsed = max(time.time() - self.started, 1)
+      self.started = time.time()
+
+    metric_data = []
+    for daemon, daemon_stats in stats.items():
+      dimensions = [{'Name': 'Daemon', 'Value': daemon}]
+      latencies = daemon_stats['latencies']
+      logging.info(f"{daemon}: {daemon_stats['messages']} messages, "
+        f"{daemon_stats['errors']} errors, "
+        f"{sum(latencies) / len(latencies):.3f}s mean latency")
+      metric_data += [
+        {'MetricName': 'MessagesPerSecond', 'Dimensions': dimensions,
+          'Value': daemon_stats['messages'] / elapsed, 'Unit': 'Count/Second'},
+        {'MetricName': 'MessageErrors', 'Dimensions': dimensions,
+          'Value': daemon_stats['errors'], 'Unit': 'Count'},
+        {'MetricName': 'ProcessingLatency', 'Dimensions': dimensions,
+          'StatisticValues': {'SampleCount': len(latencies),
+            'Sum': sum(latencies), 'Minimum': min(latencies),
+            'Maximum': max(latencies)},
+          'Unit': 'Seconds'}]
+    if not metric_data:
+      return
+    try:
+      clients.client('cloudwatch').put_metric_data(
+        Namespace=config['metrics']['Namespace'], MetricData=metric_data)
+    except ClientError as e:
+      logging.error(f"Unable to publish metrics: {e}")
+
+### EOF
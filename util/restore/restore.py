@@ -9,95 +9,299 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import os
 import sys
+import time
+import random
+import threading
 import boto3
 import json
+from concurrent.futures import ThreadPoolExecutor
 # Import utility helpers
-sys.path.insert(1, os.path.realpath(os.path.pardir))
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import helpers
+import consumer
+import clients
 import botocore.exceptions as exceptions 
-from botocore.exceptions import ClientError
+from botocore.exceptions import ClientError, BotoCoreError
 
 
 # Get configuration
 from configparser import SafeConfigParser
 config = SafeConfigParser(os.environ)
-config.read('restore_config.ini')
+config.read(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'restore_config.ini'))
 
 # Add utility code here
 
 
 
-dynamodb = boto3.client('dynamodb')
-sqs = boto3.client('sqs')
-glacier = boto3.client('glacier')
+dynamodb = clients.client('dynamodb')
+sqs = clients.client('sqs')
+glacier = clients.client('glacier')
 
-def main(): 
-    while True: 
-        response = sqs.receive_message(
-            QueueUrl=config['aws']['SQSRestoreQueueUrl'], 
-            MaxNumberOfMessages=1, 
-            WaitTimeSeconds=20)
-        try:  # Receive message
-            message = response['Messages'][0]
-            message_body = message['Body']
-            receipt_handle = message['ReceiptHandle']
-        except KeyError: # No messages in queue
-            continue
-        
-        fixed_json_string = message_body.replace("'", '"')
-        message_body_dict = json.loads(fixed_json_string)
-        try: 
-            user_id = message_body_dict['user_id']
-        except KeyError: 
-            print(f'KeyError!')
-            continue
-        _, _, _, _, role, _, _ = helpers.get_user_profile(id=user_id)
-        if role == 'premium_user': 
-            archive_ids = get_archive_ids(user_id)
-            for item in archive_ids: 
-                id = item['results_file_archive_id']['S']
-                initiate_job(id=id)
-        elif role == 'free_user': 
-            pass
-        else: 
-            print(f'Error: 500, non-standard role value')
+def handle_restore_request(message): 
+    """Start retrievals of a newly premium user's archived results
+
+    Returns True when the request message can be deleted.
+    """
+    fixed_json_string = message['Body'].replace("'", '"')
+    message_body_dict = json.loads(fixed_json_string)
+    try: 
+        user_id = message_body_dict['user_id']
+    except KeyError: 
+        print(f'KeyError!')
+        return False
+    # Restore requests follow a subscribe, so the cached role is stale
+    helpers.invalidate_user_profile(id=user_id)
+    _, _, _, _, role, _, _ = helpers.get_user_profile(id=user_id)
+    if role == 'premium_user': 
+        archive_ids = get_archive_ids(user_id)
+        if archive_ids is None: 
+            return False
+        # Leave the request to be redelivered if any retrieval could not start
+        return restore_archives(archive_ids)
+    elif role == 'free_user': 
+        pass
+    else: 
+        print(f'Error: 500, non-standard role value')
+    return True
 
-        response = sqs.delete_message(
-                QueueUrl=config['aws']['AWS_SQS_RESTORE_QUEUE_URL'], 
-                ReceiptHandle=receipt_handle)
+def make_consumer(metrics=None): 
+    return consumer.Consumer('restore', config['aws']['SQSRestoreQueueUrl'], 
+        handle_restore_request, 
+        concurrency=config.getint('restore', 'MessageConcurrency'), 
+        visibility_timeout=config.getint('restore', 'VisibilityTimeoutSeconds'), 
+        metrics=metrics)
+
+def main(): 
+    make_consumer().run()
  
 
 def get_archive_ids(user_id): 
+    """All of a user's archived jobs, or None if the query failed"""
+    query = {
+        'TableName': config['aws']['DynamodbName'], 
+        'IndexName': config['aws']['DynamoDBIndex'],
+        'Select': 'SPECIFIC_ATTRIBUTES', 
+        'ProjectionExpression': "job_id, results_file_archive_id, results_file_archive_size, archive_bundle_offset, archive_bundle_length, archive_bundle_size, restore_state", 
+        'KeyConditionExpression': "user_id = :u", 
+        'ExpressionAttributeValues': {
+            ":u": {"S": user_id}}, 
+        'FilterExpression': 'attribute_not_exists(s3_key_result_file) and attribute_exists(results_file_archive_id)' 
+    }
+    items = []
     try: 
-        response = dynamodb.query(
+        while True: 
+            response = dynamodb.query(**query)
+            items.extend(response['Items'])
+            if 'LastEvaluatedKey' not in response: 
+                return items
+            query['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    except ClientError as e: 
+        print(e)
+        return None
+
+MB = 1024 * 1024
+BUNDLE_DESCRIPTION = 'bundle'
+
+def bundle_range(items): 
+    """Glacier retrieval byte range covering some files of a bundle
+
+    Ranges must start on a megabyte boundary and end on one or at the
+    end of the archive.
+    """
+    start = min(int(item['archive_bundle_offset']['N']) for item in items)
+    end = max(int(item['archive_bundle_offset']['N']) + 
+        int(item['archive_bundle_length']['N']) for item in items)
+    size = int(items[0]['archive_bundle_size']['N'])
+    start = start // MB * MB
+    end = min(-(-end // MB) * MB, size)
+    return f'{start}-{end - 1}'
+
+class RateLimiter(object): 
+    """Spaces calls from any number of threads at least 1/rate seconds apart"""
+    def __init__(self, rate): 
+        self.interval = 1.0 / rate
+        self.next_time = time.time()
+        self.lock = threading.Lock()
+
+    def wait(self): 
+        with self.lock: 
+            now = time.time()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0: 
+            time.sleep(delay)
+
+rate_limiter = RateLimiter(config.getfloat('restore', 'RequestsPerSecond'))
+
+# Errors worth retrying: throttling and transient service faults
+RETRYABLE = {'ThrottlingException', 'LimitExceededException', 
+    'RequestTimeoutException', 'ServiceUnavailableException', 
+    'InternalFailure', 'RequestLimitExceeded'}
+
+def retrieval_tiers(size): 
+    """Tiers to try, in order, for a retrieval of size bytes (None if unknown)
+
+    Expedited only serves archives up to ExpeditedMaxMB; very large
+    retrievals go Bulk, which is far cheaper and not much slower at
+    that size. Expedited falls back to Standard when capacity runs out.
+    """
+    if size is not None and size > config.getint('restore', 'BulkMinMB') * MB: 
+        return ['Bulk']
+    if size is not None and size > config.getint('restore', 'ExpeditedMaxMB') * MB: 
+        return ['Standard']
+    return ['Expedited', 'Standard']
+
+def initiate_job(id, job_id, size=None, byte_range=None): 
+    """Start a retrieval, retrying transient errors with jittered backoff
+
+    Returns the retrieval's Glacier job ID, or None if it was not started.
+    """
+    job_parameters = {
+        'Type': 'archive-retrieval',
+        'ArchiveId': id, 
+        'Description': job_id, # Returned to thaw as JobDescription
+        'SNSTopic': config['aws']['SNSThawTopicARN']
+    }
+    if byte_range: 
+        job_parameters['RetrievalByteRange'] = byte_range
+    base = config.getfloat('restore', 'BackoffBaseSeconds')
+    cap = config.getfloat('restore', 'BackoffMaxSeconds')
+    for tier in retrieval_tiers(size): 
+        job_parameters['Tier'] = tier
+        for attempt in range(config.getint('restore', 'MaxAttempts')): 
+            rate_limiter.wait()
+            try: 
+                response = glacier.initiate_job( # Initiate job to retrieve from glacier
+                    vaultName=config['aws']['S3GlacierVaulttName'], 
+                    jobParameters=job_parameters
+                )
+                print(f"    initiating {tier} job with jobId {response['jobId']}\n       ArchivalId: {id}")
+                return response['jobId']
+            except glacier.exceptions.InsufficientCapacityException: 
+                break # Try the next tier
+            except ClientError as e: 
+                if e.response['Error']['Code'] not in RETRYABLE: 
+                    print(e)
+                    return None
+                # Full jitter: a random wait up to the exponential bound
+                time.sleep(random.uniform(0, min(cap, base * 2 ** attempt)))
+    print(f'    unable to start retrieval of {id}')
+    return None
+
+# In-flight record on a job item while its results are being restored:
+# restore_state is INITIATING from the claim until the retrieval starts,
+# then IN_PROGRESS with the retrieval's restore_job_id until thaw clears it
+INITIATING = 'INITIATING'
+IN_PROGRESS = 'IN_PROGRESS'
+
+def claim_restore(job_id): 
+    """Conditionally mark a job's archived results as being restored
+
+    Fails if the results are no longer archived or a restore is already
+    in flight, unless that record is stale: a claim older than
+    ClaimTimeoutSeconds whose retrieval never started, or any record
+    older than InFlightTimeoutSeconds. Returns True if claimed.
+    """
+    now = int(time.time())
+    try: 
+        dynamodb.update_item(
             TableName=config['aws']['DynamodbName'], 
-            IndexName=config['aws']['DynamoDBIndex'],
-            Select='SPECIFIC_ATTRIBUTES', 
-            ProjectionExpression="results_file_archive_id", 
-            KeyConditionExpression="user_id = :u", 
+            Key={'job_id': {'S': job_id}}, 
+            UpdateExpression='SET restore_state = :initiating, restore_time = :now REMOVE restore_job_id', 
+            ConditionExpression='attribute_exists(results_file_archive_id) AND (attribute_not_exists(restore_state) OR (restore_state = :initiating AND restore_time < :claim_stale) OR restore_time < :stale)', 
             ExpressionAttributeValues={
-                ":u": {"S": user_id}}, 
-            FilterExpression='attribute_not_exists(s3_key_result_file) and attribute_exists(results_file_archive_id)' 
-        )
-        return response['Items']
+                ':initiating': {'S': INITIATING}, 
+                ':now': {'N': str(now)}, 
+                ':claim_stale': {'N': str(now - config.getint('restore', 'ClaimTimeoutSeconds'))}, 
+                ':stale': {'N': str(now - config.getint('restore', 'InFlightTimeoutSeconds'))}
+            })
+        return True
     except ClientError as e: 
-        print(e)
-        return []
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException': 
+            raise
+        print(f'    skipping {job_id}: already being restored')
+        return False
 
-def initiate_job(id, tier='Expedited'): 
+def record_restore(items, retrieval_job_id): 
+    """Record the retrieval now restoring claimed job items"""
+    for item in items: 
+        dynamodb.update_item(
+            TableName=config['aws']['DynamodbName'], 
+            Key={'job_id': item['job_id']}, 
+            UpdateExpression='SET restore_state = :in_progress, restore_job_id = :job, restore_time = :now', 
+            ExpressionAttributeValues={
+                ':in_progress': {'S': IN_PROGRESS}, 
+                ':job': {'S': retrieval_job_id}, 
+                ':now': {'N': str(int(time.time()))}
+            })
+
+def release_restore(items): 
+    """Drop claims whose retrieval could not be started, so a retry can claim them"""
+    for item in items: 
+        try: 
+            dynamodb.update_item(
+                TableName=config['aws']['DynamodbName'], 
+                Key={'job_id': item['job_id']}, 
+                UpdateExpression='REMOVE restore_state, restore_time', 
+                ConditionExpression='restore_state = :initiating', 
+                ExpressionAttributeValues={':initiating': {'S': INITIATING}})
+        except ClientError as e: 
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException': 
+                print(e) # Left to expire after ClaimTimeoutSeconds
+        except BotoCoreError as e: 
+            print(e)
+
+def restore_archive(id, items): 
+    """Claim an archive's job items and start one retrieval for those claimed
+
+    A single-file archive is retrieved whole; for a bundle, one ranged
+    retrieval spans the claimed files. Items already being restored are
+    skipped. Returns False if a retrieval was needed but not started, or
+    if some items are still only claimed (INITIATING) by another attempt
+    whose retrieval may never start, so the request is tried again.
+    Claims are released whatever goes wrong before they are recorded.
+    """
+    claimed = []
+    recorded = False
     try: 
-        response = glacier.initiate_job( # Initiate job to retrieve from glacier
-            vaultName=config['aws']['S3GlacierVaulttName'], 
-            jobParameters={
-                'Type': 'archive-retrieval',
-                'ArchiveId': id, 
-                'SNSTopic': config['aws']['SNSThawTopicARN'], 
-                'Tier': tier
-            }
-        )
-        print(f"    initiating {tier} job with jobId {response['jobId']}\n       ArchivalId: {id}")
-    except glacier.exceptions.InsufficientCapacityException: 
-        initiate_job(id, tier='Standard')        
+        pending = False
+        for item in items: 
+            if claim_restore(item['job_id']['S']): 
+                claimed.append(item)
+            elif item.get('restore_state', {}).get('S') == INITIATING: 
+                pending = True
+        if not claimed: 
+            return not pending
+        if 'archive_bundle_offset' in claimed[0]: 
+            byte_range = bundle_range(claimed)
+            start, end = byte_range.split('-')
+            retrieval_job_id = initiate_job(id, BUNDLE_DESCRIPTION, 
+                int(end) - int(start) + 1, byte_range)
+        else: 
+            size = claimed[0].get('results_file_archive_size', {}).get('N')
+            retrieval_job_id = initiate_job(id, claimed[0]['job_id']['S'], 
+                int(size) if size else None)
+        if retrieval_job_id is None: 
+            return False
+        record_restore(claimed, retrieval_job_id)
+        recorded = True
+        return not pending
+    finally: 
+        if not recorded: 
+            release_restore(claimed)
+
+def restore_archives(items): 
+    """Start retrievals for archived jobs concurrently, one per archive
+
+    Returns True if every retrieval needed was started.
+    """
+    archives = {}
+    for item in items: 
+        archives.setdefault(item['results_file_archive_id']['S'], []).append(item)
+
+    with ThreadPoolExecutor(max_workers=config.getint('restore', 'Concurrency')) as executor: 
+        results = list(executor.map(lambda archive: restore_archive(*archive), archives.items()))
+    return all(results)
 
 
 if __name__ == '__main__': 
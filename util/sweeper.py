@@ -0,0 +1,51 @@
+# sweeper.py
+#
+# Periodic sweep runner for utility daemons driven by a schedule rather
+# than a queue
+#
+##
+
+import time
+import signal
+import logging
+import threading
+
+
+"""Call sweep() every `interval` seconds until stopped
+A sweep that runs long delays the next one rather than overlapping it.
+stop() (or SIGINT/SIGTERM when run() is called from the main thread)
+stops sweeping; run() returns once the sweep in progress finishes, and
+sweep() can check stopped to finish early. If metrics is given, each
+sweep's duration (and whether it raised) is recorded under the
+sweeper's name. Sweepers can be hosted by host.py like consumers.
+"""
+class Sweeper(object):
+  def __init__(self, name, sweep, interval, metrics=None):
+    self.name = name
+    self.sweep = sweep
+    self.interval = interval
+    self.metrics = metrics
+    self.stopped = threading.Event()
+
+  def stop(self, *args):
+    self.stopped.set()
+
+  def run(self):
+    if threading.current_thread() is threading.main_thread():
+      signal.signal(signal.SIGINT, self.stop)
+      signal.signal(signal.SIGTERM, self.stop)
+
+    while not self.stopped.is_set():
+      start = time.time()
+      error = False
+      try:
+        self.sweep(self.stopped)
+      except Exception:
+        # Try again at the next interval; keep the sweeper alive
+        logging.exception(f"{self.name}: error during sweep")
+        error = True
+      if self.metrics:
+        self.metrics.record(self.name, time.time() - start, error)
+      self.stopped.wait(max(0, self.interval - (time.time() - start)))
+
+### EOF
@@ -11,116 +11,358 @@ import os
 import sys
 import boto3
 import json
+import lzma
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import botocore.exceptions as exceptions 
-from botocore.exceptions import ClientError
+from botocore.exceptions import ClientError, BotoCoreError
 
 
 # Import utility helpers
-sys.path.insert(1, os.path.realpath(os.path.pardir))
+sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import helpers
+import treehash
+import compression
+import consumer
+import clients
 
 # Get configuration
 from configparser import SafeConfigParser
 config = SafeConfigParser(os.environ)
-config.read('thaw_config.ini')
+config.read(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'thaw_config.ini'))
 
 
-s3 = boto3.client('s3')
-dynamodb = boto3.client('dynamodb')
-sqs = boto3.client('sqs')
-glacier = boto3.client('glacier')
+s3 = clients.client('s3')
+dynamodb = clients.client('dynamodb')
+sqs = clients.client('sqs')
+glacier = clients.client('glacier')
 
 # Add utility code here
 
+# Retrieval job description restore.py gives ranged bundle retrievals
+BUNDLE_DESCRIPTION = 'bundle'
+
+def handle_thaw_notification(message): 
+    """Copy a completed Glacier retrieval back to S3
+
+    Returns True when the notification message can be deleted.
+    """
+    fixed_json_string = message['Body'].replace("'", '"')
+    message_dict = json.loads(json.loads(fixed_json_string)['Message'])
+    JobId = message_dict['JobId']
+    ArchiveId = message_dict['ArchiveId']
+    if message_dict['StatusCode'] != 'Succeeded': 
+        print('Error: 500 - StatusCode was not <Succeeded>')
+        # Clear the in-flight records and ask restore.py to try again
+        return release_restores(ArchiveId, JobId, message_dict.get('JobDescription'))
+    
+    byte_range = message_dict.get('RetrievalByteRange')
+    if byte_range: 
+        start, end = byte_range.split('-')
+        output_size = int(end) - int(start) + 1
+    else: 
+        output_size = message_dict['ArchiveSizeInBytes']
+    # Glacier gives the tree hash of the retrieved bytes unless the
+    # range is not tree-hash aligned
+    tree_hash = message_dict.get('SHA256TreeHash')
+
+    if message_dict.get('JobDescription') == BUNDLE_DESCRIPTION: 
+        return thaw_bundle(ArchiveId, JobId, byte_range, output_size, tree_hash)
+
+    # restore.py puts the job ID in the retrieval job's description,
+    # which avoids a table search
+    job_id = message_dict.get('JobDescription')
+    s3_key_result_file, job_id, codec = generate_s3_key_name(ArchiveId, job_id)
+    if s3_key_result_file == None: 
+        print('Error: 500 - Server Error')
+        return False
+    
+    if not thaw_to_s3(JobId, output_size, tree_hash, 
+        [(0, output_size, s3_key_result_file, codec)]): 
+        return False
+    
+    return update_dynamodb(s3_key_result_file, job_id) != None
+
+def make_consumer(metrics=None): 
+    return consumer.Consumer('thaw', config['aws']['SQSThawQueueUrl'], 
+        handle_thaw_notification, 
+        concurrency=config.getint('thaw', 'MessageConcurrency'), 
+        visibility_timeout=config.getint('thaw', 'VisibilityTimeoutSeconds'), 
+        metrics=metrics)
+
 def main(): 
-    while True: 
-        response, receipt_handle = receive_message()
-        if response == None: 
-            continue
-        message_dict = json.loads(json.loads(response)['Message'])
-        if message_dict['StatusCode'] != 'Succeeded': 
-            print('Error: 500 - StatusCode was not <Succeeded>')
-            continue
-        JobId = message_dict['JobId']
-        ArchiveId = message_dict['ArchiveId']
-        
-        body_bytes = get_job_output(JobId)
-        
-        s3_key_result_file, job_id = generate_s3_key_name(ArchiveId)
-        if s3_key_result_file == None: 
-            print('Error: 500 - Server Error')
-            continue
-        
-        if upload_to_s3(body_bytes, s3_key_result_file) == None: 
-            continue
-        
-        if update_dynamodb(s3_key_result_file, job_id) == None: 
-            continue
-        
-        delete_message(receipt_handle)
-        
-
-def receive_message(): 
-        response = sqs.receive_message(
-            QueueUrl=config['aws']['SQSThawQueueUrl'], 
-            MaxNumberOfMessages=1, 
-            WaitTimeSeconds=20)
-        try:  # Receive message
-            message = response['Messages'][0]
-            message_body = message['Body']
-            receipt_handle = message['ReceiptHandle']
-        except KeyError: # No messages in queue
-            return None, None
-        fixed_json_string = message_body.replace("'", '"')
-        message_body_dict = json.loads(fixed_json_string)
-        return fixed_json_string, receipt_handle
-
-def get_job_output(JobId): 
+    make_consumer().run()
+
+def get_job_output(JobId, start, end): 
+    """Bytes [start, end] (inclusive) of a retrieval job's output"""
     response = glacier.get_job_output(
         vaultName=config['aws']['S3GlacierVaulttName'],
-        jobId=JobId)
-    return response['body'].read()
+        jobId=JobId, 
+        range=f'bytes={start}-{end}')
+    try: 
+        return response['body'].read()
+    finally: 
+        response['body'].close()
 
-def generate_s3_key_name(ArchiveId): 
-    response = dynamodb.scan(
-        TableName=config['aws']['DynamodbName'], 
-        Select='SPECIFIC_ATTRIBUTES', 
-        ProjectionExpression="user_id, job_id, input_file_name, results_file_archive_id", 
-        FilterExpression='results_file_archive_id = :id', 
-        ExpressionAttributeValues={":id": {"S": ArchiveId}} # Would love to get exclusive start_key working
-    )
-    if len(response['Items']) == 1: 
-        job = response['Items'][0]
-        object_prefix = config['aws']['S3ObjectPrefix']
-        user_id = job['user_id']['S']
-        job_id = job['job_id']['S']
-        input_file_name = job['input_file_name']['S']
-        results_file_suffix = input_file_name.rstrip('.vcf') + '.annot.vcf'
-        s3_key_result_file = f'{object_prefix}/{user_id}/{job_id}~{results_file_suffix}'
-        return s3_key_result_file, job_id
-    elif len(response['Items']) == 0: 
-        print('Error: 404 - Item not found')
-    elif len(response['Items']) > 1: 
-        print('Error: 500 - Server Error')
-    return None, None
+class MultipartWriter(object): 
+    """Write an S3 object a part at a time through a multipart upload
+
+    With a codec, the data written is decompressed on the way, so the
+    object holds the original results. finish() uploads the last part
+    as soon as all the data is written, so no buffer is held while the
+    rest of a retrieval streams; complete() then only assembles it.
+    """
+    def __init__(self, key, codec=None): 
+        self.bucket = config['aws']['AWS_S3_RESULTS_BUCKET']
+        self.key = key
+        self.part_size = config.getint('thaw', 'PartSizeMB') * treehash.MB
+        self.decompressor = compression.Decompressor(codec) if codec else None
+        self.buffer = bytearray()
+        self.parts = []
+        self.finished = False
+        self.upload_id = s3.create_multipart_upload(
+            Bucket=self.bucket, Key=key)['UploadId']
+
+    def write(self, data): 
+        if self.decompressor: 
+            data = self.decompressor.decompress(data)
+        self.add(data)
+
+    def add(self, data): 
+        self.buffer += data
+        while len(self.buffer) >= self.part_size: 
+            self.upload_part(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
 
-def upload_to_s3(body_bytes, s3_key_result_file): 
+    def upload_part(self, data): 
+        number = len(self.parts) + 1
+        response = s3.upload_part(Bucket=self.bucket, Key=self.key, 
+            UploadId=self.upload_id, PartNumber=number, Body=data)
+        self.parts.append({'PartNumber': number, 'ETag': response['ETag']})
+
+    def finish(self): 
+        if self.decompressor: 
+            self.add(self.decompressor.flush())
+            # Ranged retrievals often come without a tree hash to check
+            if not self.decompressor.eof: 
+                raise IOError(f'Truncated compressed results for {self.key}')
+        if self.buffer or not self.parts: 
+            self.upload_part(bytes(self.buffer))
+            self.buffer = bytearray()
+        self.finished = True
+
+    def complete(self): 
+        s3.complete_multipart_upload(Bucket=self.bucket, Key=self.key, 
+            UploadId=self.upload_id, MultipartUpload={'Parts': self.parts})
+
+    def abort(self): 
+        s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, 
+            UploadId=self.upload_id)
+
+def thaw_to_s3(JobId, output_size, tree_hash, targets): 
+    """Stream a retrieval job's output into S3 objects
+
+    targets is a list of (start, end, s3_key, codec) byte ranges of the
+    output, in order and not overlapping; ranges stored compressed are
+    decompressed into their objects. The output is fetched in ChunkSizeMB
+    ranges, up to Concurrency at once, and consumed in order: each chunk
+    feeds the output's tree hash and the multipart upload of whichever
+    target it covers; a target's last part is uploaded as soon as the
+    stream has passed it. The uploads are completed only if the tree
+    hash matches Glacier's, so a corrupt retrieval never reaches S3.
+    Memory use depends on the chunk and part sizes, not on the output
+    size or the number of targets.
+    Returns True if every target was written.
+    """
+    chunk_size = config.getint('thaw', 'ChunkSizeMB') * treehash.MB
+    concurrency = config.getint('thaw', 'Concurrency')
+    ranges = deque((start, min(start + chunk_size, output_size) - 1) 
+        for start in range(0, output_size, chunk_size))
+    writers = []
     try: 
-        response = s3.put_object(
-            Body=body_bytes, 
-            Bucket=config['aws']['AWS_S3_RESULTS_BUCKET'], 
-            Key=s3_key_result_file
-        )
-        return response
-    except boto3.exceptions.S3UploadFailedError as e: # 
-        # print(e.__class__.__name__)
-        code = e.response['Error']['Code']
+        # Added one at a time, so uploads already created are aborted
+        # if a later one cannot be
+        for start, end, key, codec in targets: 
+            writers.append((start, end, MultipartWriter(key, codec)))
+        output_hash = treehash.TreeHash()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor: 
+            in_flight = deque()
+            position = 0
+            while ranges or in_flight: 
+                while ranges and len(in_flight) < concurrency: 
+                    in_flight.append(executor.submit(get_job_output, JobId, *ranges.popleft()))
+                data = in_flight.popleft().result()
+                output_hash.update(data)
+                for start, end, writer in writers: 
+                    if start < position + len(data) and end > position: 
+                        writer.write(data[max(start - position, 0):end - position])
+                    if end <= position + len(data) and not writer.finished: 
+                        writer.finish()
+                position += len(data)
+        for _, _, writer in writers: 
+            if not writer.finished: 
+                writer.finish()
+        if tree_hash and output_hash.hexdigest() != tree_hash: 
+            raise IOError(f'Tree hash mismatch for retrieval {JobId}')
+        for _, _, writer in writers: 
+            writer.complete()
+        return True
+    except (ClientError, BotoCoreError, IOError, zlib.error, lzma.LZMAError) as e: 
         print({
             'code': 500, 
             'status': 'Server Error', 
-            'message': f'S3UploadFailedError: {e}',
+            'message': f'{e}',
         })
-        return None
+        abort_writers(writers)
+        return False
+    except Exception: 
+        abort_writers(writers)
+        raise
+
+def abort_writers(writers): 
+    for _, _, writer in writers: 
+        try: 
+            writer.abort()
+        except (ClientError, BotoCoreError) as abort_error: 
+            print(abort_error)
+
+def find_archived_job(ArchiveId, job_id=None): 
+    """Job item(s) whose results are in an archive
+
+    A get_item when the job ID is known; otherwise (archives made before
+    job IDs were recorded in descriptions) a query on the archive ID index.
+    """
+    projection = "user_id, job_id, input_file_name, results_file_archive_id, results_file_archive_codec"
+    if job_id: 
+        response = dynamodb.get_item(
+            TableName=config['aws']['DynamodbName'], 
+            Key={'job_id': {'S': job_id}}, 
+            ProjectionExpression=projection)
+        job = response.get('Item')
+        if job and job.get('results_file_archive_id', {}).get('S') == ArchiveId: 
+            return [job]
+    response = dynamodb.query(
+        TableName=config['aws']['DynamodbName'], 
+        IndexName=config['aws']['ArchiveIdIndex'], 
+        Select='SPECIFIC_ATTRIBUTES', 
+        ProjectionExpression=projection, 
+        KeyConditionExpression='results_file_archive_id = :id', 
+        ExpressionAttributeValues={":id": {"S": ArchiveId}})
+    return response['Items']
+
+def results_key(job): 
+    object_prefix = config['aws']['S3ObjectPrefix']
+    user_id = job['user_id']['S']
+    job_id = job['job_id']['S']
+    input_file_name = job['input_file_name']['S']
+    results_file_suffix = input_file_name.rstrip('.vcf') + '.annot.vcf'
+    return f'{object_prefix}/{user_id}/{job_id}~{results_file_suffix}'
+
+def stored_codec(job): 
+    """Codec a job's results were archived with, or None if stored raw"""
+    codec = job.get('results_file_archive_codec', {}).get('S')
+    return codec if codec in compression.CODECS else None
+
+def find_bundle_members(ArchiveId): 
+    """Job items still archived in a bundle, with their offsets"""
+    query = {
+        'TableName': config['aws']['DynamodbName'], 
+        'IndexName': config['aws']['ArchiveIdIndex'], 
+        'Select': 'SPECIFIC_ATTRIBUTES', 
+        'ProjectionExpression': "user_id, job_id, input_file_name, archive_bundle_offset, archive_bundle_length, results_file_archive_codec", 
+        'KeyConditionExpression': 'results_file_archive_id = :id', 
+        'ExpressionAttributeValues': {":id": {"S": ArchiveId}}
+    }
+    items = []
+    while True: 
+        response = dynamodb.query(**query)
+        items.extend(response['Items'])
+        if 'LastEvaluatedKey' not in response: 
+            return items
+        query['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def thaw_bundle(ArchiveId, JobId, byte_range, output_size, tree_hash): 
+    """Restore every file of a bundle that lies in a retrieved byte range
+
+    The job items record each file's offset and length in the bundle.
+    Returns True if all of them were restored.
+    """
+    range_start = int(byte_range.split('-')[0]) if byte_range else 0
+    range_end = range_start + output_size
+    try: 
+        members = find_bundle_members(ArchiveId)
+    except ClientError as e: 
+        print(e)
+        return False
+    targets = []
+    for job in members: 
+        offset = int(job['archive_bundle_offset']['N'])
+        length = int(job['archive_bundle_length']['N'])
+        if offset < range_start or offset + length > range_end: 
+            continue
+        targets.append((offset - range_start, offset - range_start + length, 
+            results_key(job), stored_codec(job), job['job_id']['S']))
+    targets.sort()
+    if not thaw_to_s3(JobId, output_size, tree_hash, 
+        [target[:4] for target in targets]): 
+        return False
+    restored = True
+    for _, _, s3_key_result_file, _, job_id in targets: 
+        if update_dynamodb(s3_key_result_file, job_id) == None: 
+            restored = False
+    return restored
+
+def release_restores(ArchiveId, JobId, job_description): 
+    """Clear restore.py's in-flight records left by a failed retrieval
+
+    Only items whose record names this retrieval are cleared. A restore
+    request is then queued again for each of their users, delayed by
+    RestoreRetryDelaySeconds, since nothing else would retry them.
+    Returns True once done.
+    """
+    try: 
+        if job_description == BUNDLE_DESCRIPTION: 
+            jobs = find_bundle_members(ArchiveId)
+        else: 
+            jobs = find_archived_job(ArchiveId, job_description)
+        user_ids = set()
+        for job in jobs: 
+            try: 
+                dynamodb.update_item(
+                    TableName=config['aws']['DynamodbName'], 
+                    Key={'job_id': job['job_id']}, 
+                    UpdateExpression='REMOVE restore_state, restore_job_id, restore_time', 
+                    ConditionExpression='restore_job_id = :job', 
+                    ExpressionAttributeValues={':job': {'S': JobId}})
+                user_ids.add(job['user_id']['S'])
+            except ClientError as e: 
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException': 
+                    raise
+        for user_id in user_ids: 
+            sqs.send_message(
+                QueueUrl=config['aws']['SQSRestoreQueueUrl'], 
+                MessageBody=str({'user_id': user_id}), 
+                DelaySeconds=config.getint('thaw', 'RestoreRetryDelaySeconds'))
+    except ClientError as e: 
+        print(e)
+        return False
+    return True
+
+def generate_s3_key_name(ArchiveId, job_id=None): 
+    try: 
+        items = find_archived_job(ArchiveId, job_id)
+    except ClientError as e: 
+        print(e)
+        return None, None, None
+    if len(items) == 1: 
+        job = items[0]
+        return results_key(job), job['job_id']['S'], stored_codec(job)
+    elif len(items) == 0: 
+        print('Error: 404 - Item not found')
+    elif len(items) > 1: 
+        print('Error: 500 - Server Error')
+    return None, None, None
 
 def update_dynamodb(s3_key_result_file, job_id):
     try: # Update dynamodb with Glacier Archive Id                 
@@ -130,7 +372,8 @@ def update_dynamodb(s3_key_result_file, job_id):
             ExpressionAttributeValues={
                 ':f': {'S': s3_key_result_file}
             }, 
-            UpdateExpression='SET s3_key_result_file = :f REMOVE results_file_archive_id'
+            # Also clears restore.py's in-flight restore record
+            UpdateExpression='SET s3_key_result_file = :f REMOVE results_file_archive_id, results_file_archive_size, results_file_archive_codec, archive_bundle_offset, archive_bundle_length, archive_bundle_size, restore_state, restore_job_id, restore_time'
         )
         return response
     except exceptions.ClientError as e: # Error - Table does not exist
@@ -150,26 +393,6 @@ def update_dynamodb(s3_key_result_file, job_id):
             })
             return None
     
-def delete_message(receipt_handle): 
-    try: # Delete message from SQS queue
-        response = sqs.delete_message(
-            QueueUrl=config['aws']['SQSThawQueueUrl'], 
-            ReceiptHandle=receipt_handle)
-    except exceptions.ClientError as e: 
-        code = e.response['Error']['Code']
-        if code == 'ReceiptHandleIsInvalid': 
-            print({
-                'code': 500, 
-                'status': 'Server Error', 
-                'message': f'Receipt Handle Is Invalid: {e}',
-            }) 
-        else: 
-            print({
-                'code': 500, 
-                'status': 'Server Error', 
-                'message': f'An error occurred: {e}',
-            })  
-
 if __name__ == '__main__': 
     main()
 ### EOF
\ No newline at end of file
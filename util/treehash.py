@@ -0,0 +1,64 @@
+# treehash.py
+#
+# Glacier SHA-256 tree hashes, computed incrementally
+#
+##
+
+import hashlib
+
+MB = 1024 * 1024
+
+
+"""Combine 1 MB leaf digests into a tree hash (raw digest)
+Adjacent pairs are hashed together level by level; an odd digest out
+is carried up unchanged.
+"""
+def combine(leaves):
+  if not leaves:
+    return hashlib.sha256(b'').digest()
+  level = list(leaves)
+  while len(level) > 1:
+    level = [hashlib.sha256(level[i] + level[i + 1]).digest()
+      if i + 1 < len(level) else level[i]
+      for i in range(0, len(level), 2)]
+  return level[0]
+
+
+"""Incremental tree hash over data arriving in chunks of any size
+Only the digests of complete 1 MB leaves are kept, so memory use does
+not depend on the amount of data hashed. Hashes of MB-aligned pieces
+(multipart upload parts, ranged retrievals) can be joined by passing
+their leaves() to combine().
+"""
+class TreeHash(object):
+  def __init__(self, data=None):
+    self.full_leaves = []
+    self.current = hashlib.sha256()
+    self.current_size = 0
+    if data is not None:
+      self.update(data)
+
+  def update(self, data):
+    view = memoryview(data)
+    while len(view) > 0:
+      take = min(MB - self.current_size, len(view))
+      self.current.update(view[:take])
+      self.current_size += take
+      view = view[take:]
+      if self.current_size == MB:
+        self.full_leaves.append(self.current.digest())
+        self.current = hashlib.sha256()
+        self.current_size = 0
+
+  def leaves(self):
+    if self.current_size > 0:
+      return self.full_leaves + [self.current.digest()]
+    return list(self.full_leaves)
+
+  def digest(self):
+    return combine(self.leaves())
+
+  def hexdigest(self):
+    return self.digest().hex()
+
+### EOF
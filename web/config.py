@@ -95,16 +95,50 @@ class Config(object):
   # Change the ARNs below to reflect your SNS topics
   AWS_SNS_JOB_REQUEST_TOPIC = \
     "arn:aws:sns:us-east-1:659248683008:yanze41_job_requests.fifo"
+  AWS_SNS_PREMIUM_JOB_REQUEST_TOPIC = \
+    "arn:aws:sns:us-east-1:659248683008:yanze41_job_requests_premium.fifo"
   AWS_SNS_JOB_COMPLETE_TOPIC = \
     "arn:aws:sns:us-east-1:659248683008:yanze41_job_results.fifo"
 
   # Change the table name to your own
   AWS_DYNAMODB_ANNOTATIONS_TABLE = "yanze41_annotations"
+  # Index on user_id with submit_time as sort key, for newest-first listing
+  AWS_DYNAMODB_USER_INDEX = "user_id_submit_time_index"
+  # Sparse index of jobs submitted as part of a batch
+  AWS_DYNAMODB_BATCH_INDEX = "batch_id_index"
+
+  # Number of jobs per page in the annotations list
+  ANNOTATIONS_PAGE_SIZE = 25
+
+  # Most files accepted in one batch submission
+  BATCH_MAX_FILES = 100
+  # Uploads checked at once when a batch is submitted
+  BATCH_CHECK_CONCURRENCY = 10
+
+  # Job status event streams: seconds between status reads, longest a
+  # stream stays open, and most jobs one stream may watch
+  SSE_POLL_INTERVAL = 5
+  SSE_MAX_STREAM_SECONDS = 300
+  SSE_MAX_JOBS = 100
+
+  # Log and results previews: lines per page, and chunk size for streams
+  LOG_PAGE_LINES = 1000
+  RESULTS_PREVIEW_LINES = 500
+  RESULTS_PREVIEW_MAX_LINES = 5000
+  STREAM_CHUNK_SIZE = 64 * 1024
+
+  # Region/gene queries: ranges closer than the gap are fetched with one
+  # S3 range GET, and a query reads at most QUERY_MAX_BYTES of results
+  QUERY_RANGE_GAP = 64 * 1024
+  QUERY_MAX_BYTES = 16 * 1024 * 1024
+  QUERY_MAX_RESULTS = 1000
+  QUERY_INDEX_CACHE_SIZE = 32
 
   # Change the email address to your username
   MAIL_DEFAULT_SENDER = "yanze41@mpcs-cc.com"
 
-  # Time before free user results are archived (in seconds)
+  # Time before free user results are archived (in seconds); the archive
+  # sweeper's RetentionSeconds (util/archive/archive_config.ini) must match
   FREE_USER_DATA_RETENTION = 300
 
 class DevelopmentConfig(Config):
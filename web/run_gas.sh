@@ -15,10 +15,15 @@ if [ "$1" = "console" ]; then
 else
     LOG_TARGET=/home/ec2-user/mpcs-cc/gas/web/log/$GAS_LOG_FILE_NAME
 fi
+# Threaded workers: each open /annotations/events stream holds a thread,
+# not a whole worker process, and streams in one process share job status
+# reads
 /home/ec2-user/mpcs-cc/bin/gunicorn \
   --log-file=$LOG_TARGET \
   --log-level=debug \
   --workers=$GUNICORN_WORKERS \
+  --worker-class=gthread \
+  --threads=${GUNICORN_THREADS:-32} \
   --certfile=/home/ec2-user/mpcs-cc/fullchain.pem \
   --keyfile=/home/ec2-user/mpcs-cc/privkey.pem \
   --bind=$GAS_APP_HOST:$GAS_HOST_PORT gas:app
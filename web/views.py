@@ -11,16 +11,21 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 import uuid
 import time
 import json
+import base64
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from threading import Lock
 
 import boto3
 from boto3.dynamodb.conditions import Key
+from boto3.dynamodb.types import TypeSerializer
 from botocore.client import Config
 from botocore.exceptions import ClientError
 
 from flask import (abort, flash, redirect, render_template,
-  request, session, url_for, jsonify)
+  request, session, url_for, jsonify, Response, stream_with_context)
 
 from gas import app, db
 from decorators import authenticated, is_premium
@@ -80,6 +85,36 @@ def annotate():
   return render_template('annotate.html', s3_post=presigned_post)
 
 
+"""Build the job item for an uploaded input file
+The input key has the form <prefix><user_id>/<job_id>~<file name>.
+"""
+def job_item(key, bucket_name, user_id, user_email, timestamp, batch_id=None):
+  filename = key.split('~')[-1]
+  data = {"job_id": key.split('/')[2].split('~')[0],
+    "user_id": user_id,
+    "input_file_name": filename,
+    "s3_inputs_bucket": bucket_name,
+    "s3_results_bucket": app.config['AWS_S3_RESULTS_BUCKET'],
+    "s3_key_input_file": filename.replace(".vcf","")+".annot.vcf",
+    "submit_time": timestamp,
+    "user_email" : user_email,
+    "job_status": "PENDING",
+    "key": key
+  }
+  if batch_id:
+    data["batch_id"] = batch_id
+  return data
+
+
+"""Job request topic for the current user: premium jobs go to their own
+priority lane
+"""
+def job_request_topic():
+  if session.get('role') == 'premium_user':
+    return app.config['AWS_SNS_PREMIUM_JOB_REQUEST_TOPIC']
+  return app.config['AWS_SNS_JOB_REQUEST_TOPIC']
+
+
 """Fires off an annotation job
 Accepts the S3 redirect GET request, parses it to extract 
 required info, saves a job item to the database, and then
@@ -100,22 +135,8 @@ def create_annotation_job_request():
   profile = get_profile(identity_id = session.get('primary_identity'))
   user_email = profile.email
   job_id  = key.split('/')[2].split('~')[0]
-  filename = key.split('~')[-1]
-  timestamp = int(time.time())
-  key_input_file = filename.replace(".vcf","")+".annot.vcf"
-  result_bucket = app.config['AWS_S3_RESULTS_BUCKET']
   # Create a job item and persist it to the annotations database``
-  data ={ "job_id": job_id,
-      "user_id": user_id,
-      "input_file_name": filename,
-      "s3_inputs_bucket": bucket_name,
-      "s3_results_bucket": result_bucket,
-      "s3_key_input_file": key_input_file,
-      "submit_time": timestamp,
-      "user_email" : user_email,
-      "job_status": "PENDING",
-      "key": key
-  }
+  data = job_item(key, bucket_name, user_id, user_email, int(time.time()))
 
   dynamo = boto3.resource('dynamodb')
   tableName = app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE']
@@ -134,14 +155,13 @@ def create_annotation_job_request():
   # publish a notification message to the SNS topic
   sns_client = boto3.client('sns', region_name = 'us-east-1')
   message = json.dumps({"default": json.dumps(data)})
-  topic_arn = app.config['AWS_SNS_JOB_REQUEST_TOPIC']
   try:
       response = sns_client.publish(
-          TopicArn=topic_arn,
+          TopicArn=job_request_topic(),
           Message=message,
           MessageStructure='json',
-          MessageGroupId = 'requesNotification',
-          MessageDeduplicationId = 'requesNotification',
+          MessageGroupId = job_id,
+          MessageDeduplicationId = job_id,
 
       )
       
@@ -162,31 +182,275 @@ def create_annotation_job_request():
   return render_template('annotate_confirm.html', job_id=job_id)
 
 
-"""List all annotations for the user
+"""Start a batch annotation request
+Renders a form for selecting several VCF files; the page then asks
+for one presigned POST per file, uploads the files straight to S3 and
+submits the whole batch at once.
 """
-@app.route('/annotations', methods=['GET'])
+@app.route('/annotate/batch', methods=['GET'])
 @authenticated
-def annotations_list():
+def annotate_batch():
+  return render_template('annotate_batch.html',
+    max_files=app.config['BATCH_MAX_FILES'])
+
+
+"""Generate one presigned POST per file in a batch
+Takes {"files": [file names]} and returns the batch ID and, for each
+file, the S3 key (which embeds a new job ID) and the POST url/fields.
+"""
+@app.route('/annotate/batch/uploads', methods=['POST'])
+@authenticated
+def create_batch_uploads():
+  files = (request.get_json(silent=True) or {}).get('files')
+  if not isinstance(files, list) or not files or \
+    len(files) > app.config['BATCH_MAX_FILES']:
+    abort(400)
+
+  s3 = boto3.client('s3',
+    region_name=app.config['AWS_REGION_NAME'],
+    config=Config(signature_version='s3v4'))
+  user_id = session['primary_identity']
+  acl = app.config['AWS_S3_ACL']
+  # No redirect: the page uploads with XHR and just needs a status code
+  fields = {"acl": acl, "success_action_status": "201"}
+  conditions = [{"acl": acl}, {"success_action_status": "201"}]
+
+  uploads = []
+  for filename in files:
+    filename = str(filename).split('/')[-1].split('\\')[-1].replace('~', '_')
+    if not filename:
+      abort(400)
+    key = app.config['AWS_S3_KEY_PREFIX'] + user_id + '/' + \
+      str(uuid.uuid4()) + '~' + filename
+    try:
+      presigned_post = s3.generate_presigned_post(
+        Bucket=app.config['AWS_S3_INPUTS_BUCKET'],
+        Key=key,
+        Fields=fields,
+        Conditions=conditions,
+        ExpiresIn=app.config['AWS_SIGNED_REQUEST_EXPIRATION'])
+    except ClientError as e:
+      app.logger.error(f"Unable to generate presigned URL for upload: {e}")
+      abort(500)
+    uploads.append({'file': filename, 'key': key,
+      'url': presigned_post['url'], 'fields': presigned_post['fields']})
+
+  return jsonify({'batch_id': str(uuid.uuid4()), 'uploads': uploads})
+
+
+"""Publish job requests to SNS, ten per PublishBatch call
+Returns the IDs of jobs that could not be published.
+"""
+def publish_job_requests(items, topic_arn):
+  sns_client = boto3.client('sns', region_name=app.config['AWS_REGION_NAME'])
+  failed = []
+  for i in range(0, len(items), 10):
+    chunk = items[i:i + 10]
+    entries = [{
+      'Id': str(n),
+      'Message': json.dumps({"default": json.dumps(item)}),
+      'MessageStructure': 'json',
+      'MessageGroupId': item['job_id'],
+      'MessageDeduplicationId': item['job_id']} for n, item in enumerate(chunk)]
+    try:
+      response = sns_client.publish_batch(TopicArn=topic_arn,
+        PublishBatchRequestEntries=entries)
+    except ClientError as e:
+      app.logger.error(f"Unable to publish job requests: {e}")
+      failed.extend(item['job_id'] for item in chunk)
+      continue
+    for failure in response.get('Failed', []):
+      app.logger.error(f"Unable to publish job request: {failure}")
+      failed.append(chunk[int(failure['Id'])]['job_id'])
+  return failed
+
+
+"""Submit a batch of uploaded files as annotation jobs
+Takes {"batch_id": ..., "keys": [S3 keys from create_batch_uploads]}.
+Every key must name a completed upload; the uploads are checked
+concurrently. Job items are written only if absent, in transactions of
+up to 100, so a retried submission never resets a job that has started;
+if a transaction is cancelled, its items are written one by one. Job
+requests for jobs still pending are published in batches of ten.
+Messages are deduplicated on the job ID, so a failed submission can
+simply be retried.
+"""
+@app.route('/annotate/batch/submit', methods=['POST'])
+@authenticated
+def submit_batch():
+  body = request.get_json(silent=True) or {}
+  batch_id = str(body.get('batch_id', ''))
+  keys = body.get('keys')
+  user_id = session['primary_identity']
+  prefix = app.config['AWS_S3_KEY_PREFIX'] + user_id + '/'
+  if not isinstance(keys, list) or not keys or \
+    len(keys) > app.config['BATCH_MAX_FILES']:
+    abort(400)
+  # Only keys of the form create_batch_uploads hands out, under this user
+  try:
+    uuid.UUID(batch_id)
+    for key in keys:
+      job_id, _, filename = key[len(prefix):].partition('~')
+      uuid.UUID(job_id)
+      if not key.startswith(prefix) or not filename or '/' in filename:
+        abort(400)
+  except (AttributeError, TypeError, ValueError):
+    abort(400)
+
+  # Reject the batch if any upload is missing (e.g. abandoned mid-way)
+  concurrency = app.config['BATCH_CHECK_CONCURRENCY']
+  s3 = boto3.client('s3', region_name=app.config['AWS_REGION_NAME'],
+    config=Config(signature_version='s3v4', max_pool_connections=concurrency))
+  def upload_exists(key):
+    try:
+      s3.head_object(Bucket=app.config['AWS_S3_INPUTS_BUCKET'], Key=key)
+    except ClientError as e:
+      if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+        return False
+      app.logger.error(f"Unable to check upload {key}: {e}")
+      raise
+    return True
+  try:
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+      uploaded = list(executor.map(upload_exists, keys))
+  except ClientError:
+    abort(500)
+  if not all(uploaded):
+    abort(400)
+
+  user_email = get_profile(identity_id=user_id).email
+  timestamp = int(time.time())
+  items = [job_item(key, app.config['AWS_S3_INPUTS_BUCKET'], user_id,
+    user_email, timestamp, batch_id) for key in keys]
+
+  dynamodb = boto3.client('dynamodb')
+  serializer = TypeSerializer()
+  table = boto3.resource('dynamodb').Table(
+    app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
+  pending = []
+  retry = []
+  for i in range(0, len(items), 100):
+    chunk = items[i:i + 100]
+    try:
+      dynamodb.transact_write_items(TransactItems=[{'Put': {
+        'TableName': table.name,
+        'Item': {k: serializer.serialize(v) for k, v in item.items()},
+        'ConditionExpression': 'attribute_not_exists(job_id)'}}
+        for item in chunk])
+      pending.extend(chunk)
+    except ClientError as e:
+      if e.response['Error']['Code'] != 'TransactionCanceledException':
+        app.logger.error(f"Unable to write batch {batch_id}: {e}")
+        abort(500)
+      # Some written by an earlier attempt; sort them out one by one
+      retry.extend(chunk)
+
+  for item in retry:
+    try:
+      table.put_item(Item=item,
+        ConditionExpression='attribute_not_exists(job_id)')
+      pending.append(item)
+    except ClientError as e:
+      if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+        app.logger.error(f"Unable to write batch {batch_id}: {e}")
+        abort(500)
+      # Written by an earlier attempt; publish again only if not started
+      job = table.get_item(Key={'job_id': item['job_id']},
+        ConsistentRead=True).get('Item', {})
+      if job.get('user_id') != user_id:
+        abort(400)
+      if job.get('job_status') == 'PENDING':
+        pending.append(item)
+
+  failed = publish_job_requests(pending, job_request_topic())
+  result = {'batch_id': batch_id,
+    'job_ids': [item['job_id'] for item in items],
+    'url': url_for('annotation_batch', batch_id=batch_id)}
+  if failed:
+    result['failed'] = failed
+    return jsonify(result), 500
+  return jsonify(result)
+
+
+"""List the annotations submitted together in one batch
+"""
+@app.route('/annotations/batch/<batch_id>', methods=['GET'])
+@authenticated
+def annotation_batch(batch_id):
   dynamodb = boto3.client('dynamodb')
-  # dynamobName = app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE']
-  # table = dynamodb.Table(dynamobName)
+  user_id = session['primary_identity']
+  query = {
+    'TableName': app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'],
+    'IndexName': app.config['AWS_DYNAMODB_BATCH_INDEX'],
+    'KeyConditionExpression': "batch_id = :b",
+    'ExpressionAttributeValues': {":b": {"S": batch_id}}
+  }
 
+  items = []
   try: 
-    response = dynamodb.query(
-            TableName=app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'], 
-            IndexName="user_id_index",
-            Select='SPECIFIC_ATTRIBUTES', 
-            ProjectionExpression="job_id, submit_time, input_file_name, job_status", 
-            KeyConditionExpression="user_id = :u", 
-            ExpressionAttributeValues={":u": {
-                "S": session['primary_identity']}}
-        )
+    while True:
+      response = dynamodb.query(**query)
+      items.extend(response['Items'])
+      if 'LastEvaluatedKey' not in response:
+        break
+      query['ExclusiveStartKey'] = response['LastEvaluatedKey']
+  except ClientError as e: 
+    app.logger.error(f"Unable to list batch {batch_id}: {e}")
+    abort(500)
+  if not items:
+    abort(404)
+  if any(item['user_id']['S'] != user_id for item in items):
+    abort(403)
+
+  jobList = []
+  for item in sorted(items, key=lambda item: item['input_file_name']['S']):
+    jobList.append({
+      'job_id': item['job_id']['S'],
+      'submit_time': time.asctime(time.localtime(float(item['submit_time']['N']))),
+      'input_file_name': item['input_file_name']['S'],
+      'job_status': item['job_status']['S']})
 
+  return render_template('annotations.html', annotations=jobList,
+    next_page=None, batch_id=batch_id)
 
+
+"""List the user's annotations, newest first, one page at a time
+Queries the user/submit_time index in descending order; the next page
+is addressed by an opaque token wrapping DynamoDB's LastEvaluatedKey.
+"""
+@app.route('/annotations', methods=['GET'])
+@authenticated
+def annotations_list():
+  dynamodb = boto3.client('dynamodb')
+  user_id = session['primary_identity']
+
+  query = {
+    'TableName': app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'],
+    'IndexName': app.config['AWS_DYNAMODB_USER_INDEX'],
+    'Select': 'SPECIFIC_ATTRIBUTES',
+    'ProjectionExpression': "job_id, submit_time, input_file_name, job_status",
+    'KeyConditionExpression': "user_id = :u",
+    'ExpressionAttributeValues': {":u": {"S": user_id}},
+    'ScanIndexForward': False,
+    'Limit': app.config['ANNOTATIONS_PAGE_SIZE']
+  }
+  page_token = request.args.get('page')
+  if page_token:
+    try:
+      start_key = json.loads(base64.urlsafe_b64decode(page_token.encode()))
+    except ValueError:
+      abort(404)
+    if not isinstance(start_key, dict) or \
+      start_key.get('user_id', {}).get('S') != user_id:
+      abort(404)
+    query['ExclusiveStartKey'] = start_key
+
+  try: 
+    response = dynamodb.query(**query)
   except ClientError as e: 
-      return jsonify({'error': 'Error generating presigned URL'}), 500
+      app.logger.error(f"Unable to list annotations: {e}")
+      return abort(500)
 
-    
   jobList = []
   for item in response['Items']:
       d = {}
@@ -195,12 +459,117 @@ def annotations_list():
       d['input_file_name'] = item['input_file_name']['S']
       d['job_status'] = item['job_status']['S']
       jobList.append(d)
-  jobList.reverse() 
+
+  next_page = None
+  if 'LastEvaluatedKey' in response:
+    next_page = base64.urlsafe_b64encode(
+      json.dumps(response['LastEvaluatedKey']).encode()).decode()
   
-  return render_template('annotations.html', annotations=jobList)
+  return render_template('annotations.html', annotations=jobList,
+    next_page=next_page)
+
+
+"""Order a job's latency breakdown as the phases ran
+Queue wait and download come first, then the numbered pipeline stages
+(stage_NN_<table>), then the post-processing phases.
+"""
+def job_timings_in_order(timings):
+  head = ['queue_wait', 'download']
+  tail = ['cache_copy', 'merge', 'upload', 'db_update', 'notification']
+  stages = sorted(phase for phase in timings if phase.startswith('stage_'))
+  return [(phase, float(timings[phase]['N']))
+    for phase in head + stages + tail if phase in timings]
+
+
+"""Job status reads shared by all of a user's open event streams
+Each job's status is read from DynamoDB at most once per
+SSE_POLL_INTERVAL in this process, however many streams watch it; the
+per-user lock makes concurrent streams wait for one batched read
+instead of issuing their own.
+"""
+job_status_cache = {}
+job_status_locks = {}
+job_status_locks_lock = Lock()
+
+def get_job_statuses(user_id, job_ids):
+  with job_status_locks_lock:
+    user_lock = job_status_locks.setdefault(user_id, Lock())
+    # Forget jobs no stream has asked about recently
+    expired = time.time() - app.config['SSE_MAX_STREAM_SECONDS']
+    for job_id, (fetched_at, _) in list(job_status_cache.items()):
+      if fetched_at < expired:
+        job_status_cache.pop(job_id, None)
+
+  with user_lock:
+    now = time.time()
+    stale = [job_id for job_id in job_ids if job_id not in job_status_cache or
+      now - job_status_cache[job_id][0] >= app.config['SSE_POLL_INTERVAL']]
+    dynamodb = boto3.client('dynamodb')
+    table_name = app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE']
+    for i in range(0, len(stale), 100):
+      request_items = {table_name: {
+        'Keys': [{'job_id': {'S': job_id}} for job_id in stale[i:i + 100]],
+        'ProjectionExpression': "job_id, user_id, job_status, job_progress"}}
+      while request_items:
+        response = dynamodb.batch_get_item(RequestItems=request_items)
+        for item in response['Responses'].get(table_name, []):
+          # Shard sub-jobs have no user_id, so never match a user
+          status = {
+            'job_id': item['job_id']['S'],
+            'user_id': item.get('user_id', {}).get('S'),
+            'job_status': item.get('job_status', {}).get('S')}
+          if 'job_progress' in item:
+            status['job_progress'] = {name: value.get('S', value.get('N'))
+              for name, value in item['job_progress']['M'].items()}
+          job_status_cache[status['job_id']] = (now, status)
+        request_items = response.get('UnprocessedKeys')
+
+  statuses = {}
+  for job_id in job_ids:
+    if job_id in job_status_cache and \
+      job_status_cache[job_id][1]['user_id'] == user_id:
+      status = dict(job_status_cache[job_id][1])
+      del status['user_id']
+      statuses[job_id] = status
+  return statuses
 
 
+"""Server-sent events stream of status and progress for a user's jobs
+Takes a comma-separated list of job IDs in ?ids= and pushes an event
+whenever one of them changes; the stream ends when all jobs are
+COMPLETED or after SSE_MAX_STREAM_SECONDS (browsers reconnect).
+"""
+@app.route('/annotations/events', methods=['GET'])
+@authenticated
+def annotation_events():
+  user_id = session['primary_identity']
+  job_ids = [job_id for job_id in request.args.get('ids', '').split(',')
+    if job_id][:app.config['SSE_MAX_JOBS']]
 
+  def stream():
+    last_sent = {}
+    deadline = time.time() + app.config['SSE_MAX_STREAM_SECONDS']
+    while time.time() < deadline:
+      try:
+        statuses = get_job_statuses(user_id, job_ids)
+      except ClientError as e:
+        app.logger.error(f"Unable to read job statuses: {e}")
+        return
+      for job_id, status in statuses.items():
+        if last_sent.get(job_id) != status:
+          yield f"event: status\ndata: {json.dumps(status)}\n\n"
+          last_sent[job_id] = status
+      if statuses and all(status['job_status'] == 'COMPLETED'
+        for status in statuses.values()):
+        yield "event: done\ndata: {}\n\n"
+        return
+      # Comment line keeps proxies from closing an idle stream
+      yield ": keepalive\n\n"
+      time.sleep(app.config['SSE_POLL_INTERVAL'])
+
+  return Response(stream_with_context(stream()),
+    mimetype='text/event-stream',
+    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 """Display details of a specific annotation job
@@ -230,6 +599,11 @@ def annotation_details(id):
     annotation['submit_time'] = time.asctime(time.localtime(float(job['submit_time']['N'])))
     annotation['input_file_name'] = job['input_file_name']['S']
     annotation['job_status'] = job['job_status']['S']
+    if 'job_timings' in job:
+        annotation['job_timings'] = job_timings_in_order(job['job_timings']['M'])
+    if annotation['job_status'] == 'RUNNING' and 'job_progress' in job:
+        annotation['job_progress'] = {name: value.get('S', value.get('N'))
+            for name, value in job['job_progress']['M'].items()}
 
     free_access_expired = False
     restore_message = False
@@ -261,32 +635,290 @@ def annotation_details(id):
         annotation=annotation, free_access_expired=free_access_expired)
 
 
-"""Display the log file contents for an annotation job
+"""Get a job item owned by the current user, or abort
+"""
+def get_owned_job(id):
+    dynamodb = boto3.client('dynamodb')
+    try: 
+        response = dynamodb.get_item(
+            TableName=app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'], 
+            Key={'job_id': {'S': id}})
+    except ClientError as e: 
+        app.logger.error(f"Unable to read job {id}: {e}")
+        abort(500)
+    job = response.get('Item')
+    if not job: 
+        abort(404)
+    if job['user_id']['S'] != session['primary_identity']: 
+        abort(403)
+    return job
+
+
+"""Read a window of lines from an S3 object, starting at a byte offset
+Only the requested window is fetched and decoded (a ranged GET whose
+stream is closed once enough lines are read), so memory use does not
+depend on object size. Returns the lines and the byte offset of the
+next window, or None at the end of the object.
+"""
+def read_line_window(key, offset, max_lines, skip_headers=False):
+    s3 = boto3.client('s3')
+    try: 
+        response = s3.get_object(
+            Bucket=app.config['AWS_S3_RESULTS_BUCKET'],
+            Key=key,
+            Range=f'bytes={offset}-')
+    except ClientError as e: 
+        code = e.response['Error']['Code']
+        if code == 'InvalidRange': # Offset is past the end
+            return [], None
+        elif code == 'NoSuchKey' or code == 'NoSuchBucket': 
+            abort(404)
+        else: 
+            abort(500)
+
+    body = response['Body']
+    lines = []
+    next_offset = None
+    try:
+        for line in body.iter_lines(keepends=True):
+            offset += len(line)
+            if skip_headers and line.startswith(b'#'):
+                continue
+            lines.append(line.decode())
+            if len(lines) >= max_lines:
+                next_offset = offset
+                break
+    finally:
+        body.close()
+    return lines, next_offset
+
+
+"""Parse a non-negative integer query argument
+"""
+def int_arg(name, default, maximum=None):
+    try:
+        value = max(0, int(request.args.get(name, default)))
+    except ValueError:
+        abort(404)
+    return min(value, maximum) if maximum is not None else value
+
+
+"""Display the log file contents for an annotation job, a page at a time
 """
 @app.route('/annotations/<id>/log', methods=['GET'])
 @authenticated
 def annotation_log(id):
-    s3 = boto3.client('s3')
-    
-    s3_key_log_file = request.args.get('s3_key_log_file')
+    job = get_owned_job(id)
+    if 's3_key_log_file' not in job:
+        abort(404)
+
+    offset = int_arg('offset', 0)
+    lines, next_offset = read_line_window(job['s3_key_log_file']['S'],
+        offset, app.config['LOG_PAGE_LINES'])
+
+    return render_template('view_log.html', job_id=id,
+        log_file_contents=''.join(lines), next_offset=next_offset)
+
 
+"""Stream the whole log file for an annotation job as plain text
+"""
+@app.route('/annotations/<id>/log/raw', methods=['GET'])
+@authenticated
+def annotation_log_raw(id):
+    job = get_owned_job(id)
+    if 's3_key_log_file' not in job:
+        abort(404)
+
+    s3 = boto3.client('s3')
     try: 
         response = s3.get_object(
             Bucket=app.config['AWS_S3_RESULTS_BUCKET'],
-            Key=s3_key_log_file)
+            Key=job['s3_key_log_file']['S'])
     except ClientError as e: 
         code = e.response['Error']['Code']
         if code == 'NoSuchKey' or code == 'NoSuchBucket': 
             abort(404)
         else: 
             abort(500)
-    # except ParamValidationError as e: 
-    #     abort(404)
 
-    log_file_contents = response['Body'].read().decode()
+    def stream():
+        try:
+            for chunk in response['Body'].iter_chunks(app.config['STREAM_CHUNK_SIZE']):
+                yield chunk
+        finally:
+            response['Body'].close()
 
-    return render_template('view_log.html', job_id=id, log_file_contents=log_file_contents) # log_file_contents)
+    return Response(stream(), mimetype='text/plain',
+        headers={'Content-Length': str(response['ContentLength'])})
+
+
+"""Preview a window of annotated variants from the results file
+?offset= is the byte offset to start at (from the previous window) and
+?lines= the number of variants to show.
+"""
+@app.route('/annotations/<id>/results', methods=['GET'])
+@authenticated
+def annotation_results_preview(id):
+    job = get_owned_job(id)
+    if 's3_key_result_file' not in job:
+        abort(404)
+
+    offset = int_arg('offset', 0)
+    max_lines = int_arg('lines', app.config['RESULTS_PREVIEW_LINES'],
+        app.config['RESULTS_PREVIEW_MAX_LINES'])
+    lines, next_offset = read_line_window(job['s3_key_result_file']['S'],
+        offset, max_lines, skip_headers=True)
+
+    return render_template('view_results.html', job_id=id,
+        results_contents=''.join(lines), next_offset=next_offset,
+        lines=max_lines)
+
+
+
+"""Sidecar indexes of completed results, by S3 key
+Results never change once written, so an index is fetched from S3 once
+per process; the least recently used are dropped past QUERY_INDEX_CACHE_SIZE.
+"""
+result_index_cache = OrderedDict()
+result_index_cache_lock = Lock()
+
+def get_result_index(key):
+    with result_index_cache_lock:
+        if key in result_index_cache:
+            result_index_cache.move_to_end(key)
+            return result_index_cache[key]
+
+    s3 = boto3.client('s3')
+    try: 
+        response = s3.get_object(
+            Bucket=app.config['AWS_S3_RESULTS_BUCKET'], Key=key)
+    except ClientError as e: 
+        code = e.response['Error']['Code']
+        if code == 'NoSuchKey' or code == 'NoSuchBucket': 
+            abort(404)
+        else: 
+            abort(500)
+    index = json.loads(response['Body'].read())
+
+    with result_index_cache_lock:
+        result_index_cache[key] = index
+        while len(result_index_cache) > app.config['QUERY_INDEX_CACHE_SIZE']:
+            result_index_cache.popitem(last=False)
+    return index
+
+
+"""Parse a region such as chr17:41196312-41277500, 17:41196312 or chrX
+Returns (chrom, start, end) with the "chr" prefix dropped, as in the
+index; start and end are None when the whole chromosome is requested.
+"""
+def parse_region(region):
+    chrom, _, span = region.replace(',', '').partition(':')
+    chrom = chrom[3:] if chrom.startswith('chr') else chrom
+    if not chrom:
+        abort(400)
+    if not span:
+        return chrom, None, None
+    start, _, end = span.partition('-')
+    try:
+        start = int(start)
+        end = int(end) if end else start
+    except ValueError:
+        abort(400)
+    if end < start:
+        abort(400)
+    return chrom, start, end
+
+
+"""Merge sorted [start, end) byte ranges that are less than gap apart
+"""
+def coalesce_ranges(ranges, gap):
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start - merged[-1][1] < gap:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+"""Query annotated variants by region (?region=chr17:41196312-41277500)
+or gene symbol (?gene=BRCA1)
+The sidecar index written by the annotator maps coordinate bins and
+gene symbols to byte ranges of the results file, so only those ranges
+are read, with S3 range GETs; lines are then filtered exactly. At most
+QUERY_MAX_BYTES are read and QUERY_MAX_RESULTS variants returned;
+"truncated" is set if either limit was reached.
+"""
+@app.route('/annotations/<id>/query', methods=['GET'])
+@authenticated
+def annotation_query(id):
+    job = get_owned_job(id)
+    if 's3_key_index_file' not in job or 's3_key_result_file' not in job:
+        abort(404)
+    region = request.args.get('region')
+    gene = request.args.get('gene')
+    if bool(region) == bool(gene):
+        abort(400)
+
+    index = get_result_index(job['s3_key_index_file']['S'])
+    if region:
+        chrom, start, end = parse_region(region)
+        bins = index['bins'].get(chrom, {})
+        if start is not None:
+            # Filter the index's own bins; the region may be huge
+            first, last = start // index['bin_size'], end // index['bin_size']
+            bins = {number: bin_ranges for number, bin_ranges in bins.items()
+                if first <= int(number) <= last}
+        ranges = [r for bin_ranges in bins.values() for r in bin_ranges]
+
+        def matches(fields):
+            field_chrom = fields[0][3:] if fields[0].startswith('chr') else fields[0]
+            if field_chrom != chrom:
+                return False
+            if start is None:
+                return True
+            try:
+                return start <= int(fields[1]) <= end
+            except ValueError:
+                return False
+    else:
+        ranges = index['genes'].get(gene, [])
+        symbol = 'name2=' + gene
+
+        def matches(fields):
+            return symbol in fields[7].split(';')
+
+    s3 = boto3.client('s3')
+    variants = []
+    bytes_read = 0
+    truncated = False
+    for range_start, range_end in coalesce_ranges(ranges, app.config['QUERY_RANGE_GAP']):
+        if bytes_read + range_end - range_start > app.config['QUERY_MAX_BYTES']:
+            truncated = True
+            break
+        try: 
+            response = s3.get_object(
+                Bucket=app.config['AWS_S3_RESULTS_BUCKET'],
+                Key=job['s3_key_result_file']['S'],
+                Range=f'bytes={range_start}-{range_end - 1}')
+        except ClientError as e: 
+            code = e.response['Error']['Code']
+            if code == 'NoSuchKey' or code == 'NoSuchBucket': 
+                abort(404) # Results have been archived
+            else: 
+                abort(500)
+        bytes_read += range_end - range_start
+        for line in response['Body'].read().decode().splitlines():
+            fields = line.split('\t')
+            if len(fields) >= 8 and matches(fields):
+                variants.append(line)
+        if len(variants) >= app.config['QUERY_MAX_RESULTS']:
+            variants = variants[:app.config['QUERY_MAX_RESULTS']]
+            truncated = True
+            break
 
+    return jsonify({'job_id': id, 'region': region, 'gene': gene,
+        'variants': variants, 'truncated': truncated})
 
 
 """Subscription management handler